@@ -17,9 +17,23 @@ This code is referenced from PaddlePaddle models.
 
 import os
 import sys
+import select
+import json
+import time
+import contextlib
+import glob
+import shutil
+import tempfile
+import zlib
 import random
 import argparse
 import collections
+import multiprocessing
+import numpy as np
+try:
+    import resource         # Windows环境下没有resource模块, 不统计内存峰值
+except ImportError:
+    resource = None
 
 # There are 13 numeric features and 26 categorical features
 # 数值特征I1-I13(整数), 离散特征C1-C26
@@ -38,6 +52,9 @@ class CategoryDictGenerator:
     Generate dictionary for each of the categorical features
     """
 
+    # 是否需要统计离散特征值的频次
+    counting = True
+
     def __init__(self, num_feature):
         self.dicts = []
         self.num_feature = num_feature
@@ -45,14 +62,42 @@ class CategoryDictGenerator:
             self.dicts.append(collections.defaultdict(int))
 
     def build(self, datafile, categorical_feature, cutoff=0):
+        # 返回统计的行数
+        rows = 0
         with open(datafile, 'r') as f:
             for line in f:
                 features = line.rstrip('\n').split('\t')
-                # 遍历离散特征,统计不同离散特征值出现次数
-                for i in range(0, self.num_feature):
-                    if features[categorical_feature[i]] != '':
-                        self.dicts[i][features[categorical_feature[i]]] += 1
+                self.update(features, categorical_feature)
+                rows += 1
+        self.finalize(cutoff)
+        return rows
+
+    def update(self, features, categorical_feature):
+        # 遍历离散特征,统计不同离散特征值出现次数
+        for i in range(0, self.num_feature):
+            key = features[categorical_feature[i]]
+            if key != '':
+                self.dicts[i][key] += 1
+
+    def add_counts(self, idx, keys, cnts):
+        # keys: 去重后的bytes数组, cnts: 对应的出现次数
+        counts = self.dicts[idx]
+        for key, cnt in zip(keys.tolist(), cnts.tolist()):
+            counts[key.decode('utf-8')] += cnt
 
+    def merge(self, other):
+        # 合并其他分片统计的离散特征频次
+        for counts, other_counts in zip(self.dicts, other.dicts):
+            for key, cnt in other_counts.items():
+                counts[key] += cnt
+
+    def new_shard(self, num_shards):
+        # 并行统计时每个分片使用的空生成器
+        return CategoryDictGenerator(self.num_feature)
+
+    def finalize(self, cutoff=0):
+        # cutoff之前每个离散特征的不同取值数
+        self.distinct_sizes = [len(counts) for counts in self.dicts]
         for j in range(0, self.num_feature):
             # 剔除频次小于cutoff的离散特征,剩下特征按频次从大到小排序
             temp_list = filter(lambda x: x[1] >= cutoff, self.dicts[j].items())
@@ -70,39 +115,1742 @@ class CategoryDictGenerator:
             res = self.dicts[idx][key]
         return res
 
+    def lookup(self, idx, keys):
+        # keys: 去重后的bytes数组, 返回对应的特征编号
+        return np.array([self.gen(idx, key.decode('utf-8')) for key in keys.tolist()], dtype=np.int64)
+
+    def items(self, idx):
+        return self.dicts[idx].items()
+
     def dicts_sizes(self):
         return map(len, self.dicts)
 
+    def compact(self):
+        """
+        Convert the built dictionaries to a CategoryVocab of sorted uint32 key
+        arrays, return self if the values are not 8-digit hex.
+        """
+        arrays = vocab_arrays(self)
+        if arrays is None:
+            return self
+        return CategoryVocab(*arrays)
+
+
+def _mix64(x):
+    # splitmix64 finalizer, x: uint64 array
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def key_fingerprints(keys, idx):
+    """
+    Hash a fixed-width bytes array of categorical values of field idx
+    into uint64 fingerprints. Only the words of each value itself are mixed,
+    so a fingerprint does not depend on the array width(other values of the block).
+    """
+    width = keys.dtype.itemsize
+    fps = np.full(keys.size, idx + 1, dtype=np.uint64)
+    if width <= 8:
+        padded = keys.astype('S8') if width < 8 else keys
+        return _mix64(fps ^ np.ascontiguousarray(padded).view(np.uint64))
+    padded = np.zeros((keys.size, (width + 7) // 8 * 8), dtype=np.uint8)
+    padded[:, :width] = keys.view(np.uint8).reshape(-1, width)
+    words = padded.view(np.uint64)
+    # 每个值的字数, 超过8字节的值才混入后面的字, 与所在数组的宽度无关
+    num_words = np.maximum((np.char.str_len(keys) + 7) // 8, 1)
+    fps = _mix64(fps ^ words[:, 0])
+    for k in range(1, words.shape[1]):
+        fps = np.where(num_words > k, _mix64(fps ^ words[:, k]), fps)
+    return fps
+
+
+class CountMinSketch:
+    """
+    Count-min sketch over uint64 fingerprints in a fixed [depth, width] uint32
+    table. Estimates never undercount, and overcount by at most e/width*total
+    with probability 1-exp(-depth).
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = None       # 首次写入时再分配, 空sketch可以廉价地传给子进程
+
+    def _index(self, fps):
+        h = _mix64(fps)
+        h1 = h & np.uint64(0xffffffff)
+        h2 = (h >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        with np.errstate(over='ignore'):
+            return ((h1 + rows * h2) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, fps, cnts):
+        if self.table is None:
+            self.table = np.zeros((self.depth, self.width), dtype=np.uint32)
+        index = self._index(fps)
+        for r in range(0, self.depth):
+            np.add.at(self.table[r], index[r], cnts.astype(np.uint32))
+        self.total += int(cnts.sum())
+
+    def query(self, fps):
+        if self.table is None:
+            return np.zeros(fps.size, dtype=np.int64)
+        index = self._index(fps)
+        est = self.table[0, index[0]]
+        for r in range(1, self.depth):
+            est = np.minimum(est, self.table[r, index[r]])
+        return est.astype(np.int64)
+
+    def merge(self, other):
+        if other.table is not None:
+            if self.table is None:
+                self.table = other.table.copy()
+            else:
+                self.table += other.table
+        self.total += other.total
+
+    def error_bound(self):
+        return int(np.ceil(np.e / self.width * self.total))
+
+
+class CategorySketchGenerator(CategoryDictGenerator):
+    """
+    Approximate CategoryDictGenerator with bounded memory: value counts go to
+    one count-min sketch shared by all fields, only values whose estimated
+    count reaches threshold are kept as heavy-hitter candidates. No value above
+    the cutoff is missed, values within the error bound may be kept wrongly.
+    With parallel counting, sketch_mb is shared by the parent and the shards.
+    """
+
+    def __init__(self, num_feature, sketch_mb=64, depth=4, threshold=1):
+        super().__init__(num_feature)
+        self.sketch = CountMinSketch(self.sketch_width(sketch_mb, depth), depth)
+        self.sketch_mb = sketch_mb
+        self.threshold = threshold
+        self.misclassified = [0] * num_feature
+        # dicts[i]: 候选离散特征值 -> 指纹
+        self.dicts = [{} for _ in range(0, num_feature)]
+
+    def update(self, features, categorical_feature):
+        for i in range(0, self.num_feature):
+            key = features[categorical_feature[i]]
+            if key != '':
+                self.add_counts(i, np.array([key.encode('utf-8')]), np.ones(1, dtype=np.int64))
+
+    def add_counts(self, idx, keys, cnts):
+        fps = key_fingerprints(keys, idx)
+        self.sketch.add(fps, cnts)
+        hit = self.sketch.query(fps) >= self.threshold
+        candidates = self.dicts[idx]
+        for key, fp in zip(keys[hit].tolist(), fps[hit].tolist()):
+            candidates[key.decode('utf-8')] = fp
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        for candidates, other_candidates in zip(self.dicts, other.dicts):
+            candidates.update(other_candidates)
+
+    @staticmethod
+    def sketch_width(sketch_mb, depth):
+        # 宽度取满足内存预算的最大2的幂
+        return 1 << int(np.log2(max(int(sketch_mb * (1 << 20)) // (4 * depth), 1)))
+
+    def new_shard(self, num_shards):
+        # 总频次>=threshold的值至少在一个分片中频次>=threshold/num_shards
+        threshold = max((self.threshold + num_shards - 1) // num_shards, 1)
+        # num_shards个子进程和合并结果的父进程各持有一张表, 平分内存预算, 合并要求宽度一致
+        shard_mb = self.sketch_mb / (num_shards + 1)
+        width = self.sketch_width(shard_mb, self.sketch.depth)
+        if self.sketch.width != width:
+            if self.sketch.table is not None:
+                raise ValueError("cannot shard a sketch that already has counts")
+            self.sketch = CountMinSketch(width, self.sketch.depth)
+        shard = CategorySketchGenerator(self.num_feature, self.sketch_mb, self.sketch.depth, threshold)
+        shard.sketch = CountMinSketch(width, self.sketch.depth)
+        return shard
+
+    def finalize(self, cutoff=0):
+        bound = self.sketch.error_bound()
+        for j in range(0, self.num_feature):
+            keys = list(self.dicts[j].keys())
+            est = self.sketch.query(np.array(list(self.dicts[j].values()), dtype=np.uint64))
+            # 估计值 - 误差上界 < cutoff 的值可能被错误保留
+            self.misclassified[j] = int(np.count_nonzero((est >= cutoff) & (est - bound < cutoff)))
+            self.dicts[j] = dict(zip(keys, est.tolist()))
+        super().finalize(cutoff)
+
+
+def hex_to_uint32(keys):
+    """
+    Parse a bytes array of 8-digit lowercase hex values (hashed Criteo values)
+    to uint32, return the values and the mask of well-formed keys.
+    """
+    keys = np.asarray(keys)
+    if keys.dtype.itemsize != 8:
+        # 长度不是8的值一律非法, 短值补齐到8位后同样会因为'\0'被判为非法
+        if keys.dtype.itemsize > 8:
+            return np.zeros(keys.size, dtype=np.uint32), np.zeros(keys.size, dtype=bool)
+        keys = keys.astype('S8')
+    chars = keys.view(np.uint8).reshape(-1, 8).astype(np.int64)
+    valid = np.all(((chars >= 48) & (chars <= 57)) | ((chars >= 97) & (chars <= 102)), axis=1)
+    digits = np.where(chars >= 97, chars - 87, chars - 48)
+    values = digits.dot(16 ** np.arange(7, -1, -1, dtype=np.int64))
+    return np.where(valid, values, 0).astype(np.uint32), valid
+
+
+class CategoryVocab:
+    """
+    Categorical dictionaries loaded from a vocabulary artifact. The values of
+    field i are keys[ptr[i]:ptr[i+1]], sorted uint32 with their ids, and are
+    looked up by np.searchsorted. keys/ids can be memory-mapped.
+    """
+
+    def __init__(self, keys, ids, ptr):
+        self.keys = keys
+        self.ids = ids
+        self.ptr = ptr
+        self.num_feature = len(ptr) - 1
+        self.dicts = None
+
+    def lookup(self, idx, keys):
+        field_keys = self.keys[self.ptr[idx]:self.ptr[idx + 1]]
+        field_ids = self.ids[self.ptr[idx]:self.ptr[idx + 1]]
+        values, valid = hex_to_uint32(keys)
+        if field_keys.size == 0:
+            return np.zeros(values.size, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(field_keys, values), field_keys.size - 1)
+        found = valid & (field_keys[pos] == values)
+        return np.where(found, field_ids[pos], 0).astype(np.int64)
+
+    def gen(self, idx, key):
+        # 逐行处理时按需还原为dict, 避免每个值调用一次searchsorted
+        if self.dicts is None:
+            self.dicts = [dict(self.items(j)) for j in range(0, self.num_feature)]
+        return self.dicts[idx].get(key, 0)
+
+    def items(self, idx):
+        # 与CategoryDictGenerator.dicts[idx]相同的顺序: 编号1..n, 最后为<unk>
+        field_keys = self.keys[self.ptr[idx]:self.ptr[idx + 1]]
+        field_ids = self.ids[self.ptr[idx]:self.ptr[idx + 1]]
+        order = np.argsort(field_ids, kind='stable')
+        for key, val in zip(field_keys[order].tolist(), field_ids[order].tolist()):
+            yield "%08x" % key, val
+        yield '<unk>', 0
+
+    def dicts_sizes(self):
+        return [int(n) + 1 for n in np.diff(self.ptr)]
+
+
+def vocab_arrays(c_feat):
+    """
+    Flatten categorical dictionaries to (keys, ids, ptr): uint32 hex values
+    sorted per field, int32 ids of the keys and field pointers.
+    Return None if any value is not 8-digit hex.
+    """
+    if isinstance(c_feat, CategoryVocab):
+        return c_feat.keys, c_feat.ids, c_feat.ptr
+    all_keys, all_ids, ptr = [], [], [0]
+    for j in range(0, c_feat.num_feature):
+        pairs = [(key, val) for key, val in c_feat.items(j) if key != '<unk>']
+        if any(len(key) != 8 for key, _ in pairs):
+            return None
+        values, valid = hex_to_uint32(np.array([key.encode('utf-8') for key, _ in pairs], dtype='S8'))
+        if not np.all(valid):
+            return None
+        ids = np.array([val for _, val in pairs], dtype=np.int32)
+        order = np.argsort(values, kind='stable')
+        all_keys.append(values[order])
+        all_ids.append(ids[order])
+        ptr.append(ptr[-1] + len(pairs))
+    return np.concatenate(all_keys).astype(np.uint32), np.concatenate(all_ids).astype(np.int32), ptr
+
+
+def save_vocab(prefix, n_feat, c_feat, c_feat_offset, cutoff):
+    """
+    Save min/max, offsets and categorical dictionaries as a reloadable artifact:
+    {prefix}.keys.npy uint32 hex values sorted per field, {prefix}.ids.npy
+    int32 ids of the keys and {prefix}.json with field pointers and the rest.
+    """
+    arrays = vocab_arrays(c_feat)
+    if arrays is None:
+        print("Categorical values are not 8-digit hex, vocabulary artifact is not saved")
+        return False
+    keys, ids, ptr = arrays
+    np.save(prefix + ".keys.npy", keys)
+    np.save(prefix + ".ids.npy", ids)
+    meta = {"min": n_feat.min, "max": n_feat.max, "clip": n_feat.clip, "clip_quantile": n_feat.clip_quantile,
+            "bounds": n_feat.bounds, "ptr": list(ptr), "offset": c_feat_offset,
+            "cutoff": cutoff, "feature_size": c_feat_offset[-1] + 1}
+    with open(prefix + ".json", 'w') as f:
+        json.dump(meta, f)
+    return True
+
+
+def load_vocab(prefix):
+    """
+    Load the artifact written by save_vocab, return (n_feat, c_feat).
+    """
+    with open(prefix + ".json", 'r') as f:
+        meta = json.load(f)
+    n_feat = NumericFeatureGenerator(len(meta["min"]))
+    n_feat.min = meta["min"]
+    n_feat.max = meta["max"]
+    n_feat.clip = meta.get("clip", n_feat.clip)
+    n_feat.clip_quantile = meta.get("clip_quantile", 0.0)
+    if meta.get("bounds") is not None:
+        n_feat.bounds = meta["bounds"]
+        n_feat.offset = np.cumsum([0] + n_feat.dicts_sizes()).tolist()
+    c_feat = CategoryVocab(np.load(prefix + ".keys.npy", mmap_mode='r'),
+                           np.load(prefix + ".ids.npy", mmap_mode='r'), meta["ptr"])
+    return n_feat, c_feat
+
+
+def save_counts(path, n_feat, c_feat):
+    """
+    Save numeric min/max and raw categorical counts(before cutoff) to an .npz file,
+    counts of several files can be merged to rebuild the vocabulary without rescanning.
+    """
+    arrays = {"min": np.array(n_feat.min, dtype=np.int64), "max": np.array(n_feat.max, dtype=np.int64)}
+    for j in range(0, c_feat.num_feature):
+        counts = c_feat.dicts[j]
+        arrays["keys_%d" % j] = np.array([key.encode('utf-8') for key in counts.keys()], dtype=bytes)
+        arrays["cnts_%d" % j] = np.array(list(counts.values()), dtype=np.int64)
+    np.savez(path, **arrays)
+
+
+def load_counts(paths):
+    """
+    Load and merge count files written by save_counts, return (n_feat, c_feat) before finalize.
+    """
+    n_feat = NumericFeatureGenerator(len(numeric_features))
+    c_feat = CategoryDictGenerator(len(categorical_features))
+    for path in paths:
+        with np.load(path) as arrays:
+            other_n = NumericFeatureGenerator(len(numeric_features))
+            other_n.min, other_n.max = arrays["min"].tolist(), arrays["max"].tolist()
+            n_feat.merge(other_n)
+            for j in range(0, c_feat.num_feature):
+                c_feat.add_counts(j, arrays["keys_%d" % j], arrays["cnts_%d" % j])
+    return n_feat, c_feat
+
+
+class CategoryHashGenerator:
+    """
+    Hashing trick for categorical features without any dictionary:
+    value -> 1 + hash(field, value) % buckets, missing value -> 0(<unk>).
+    The id depends only on the field and the value bytes, not on the other
+    values looked up in the same block.
+    """
+
+    counting = False
+
+    def __init__(self, num_feature, buckets):
+        self.num_feature = num_feature
+        self.buckets = buckets
+
+    def lookup(self, idx, keys):
+        ids = (key_fingerprints(keys, idx) % np.uint64(self.buckets)).astype(np.int64) + 1
+        ids[keys == b''] = 0
+        return ids
+
+    def gen(self, idx, key):
+        return int(self.lookup(idx, np.array([key.encode('utf-8')]))[0])
+
+    def merge(self, other):
+        pass
+
+    def new_shard(self, num_shards):
+        return self
+
+    def finalize(self, cutoff=0):
+        pass
+
+    def items(self, idx):
+        # 无法枚举原始值, 只输出<unk>和第一个哈希桶的编号
+        return [('<unk>', 0), ('<hash>', 1)]
+
+    def dicts_sizes(self):
+        return [self.buckets + 1] * self.num_feature
+
+
+class CrossFeatureGenerator:
+    """
+    Hashed field crosses for the wide part, e.g. 'C1xC2,C1xC2xC3'.
+    Cross k of a row -> k * buckets + hash(k, encoded ids of its fields) % buckets,
+    so all crosses share one weight table of len(crosses) * buckets.
+    Crosses are keyed on the encoded feat_idx(after cutoff/bucketization), numeric
+    fields take part only as quantile buckets(--numeric_buckets).
+    """
+
+    def __init__(self, crosses, buckets):
+        self.buckets = buckets
+        self.crosses = []
+        self.numeric = False
+        for cross in crosses.split(','):
+            cols = []
+            for name in cross.strip().split('x'):
+                num = int(name[1:]) if name[1:].isdigit() else 0
+                if name[:1] == 'I' and 1 <= num <= len(numeric_features):
+                    cols.append(num - 1)
+                    self.numeric = True
+                elif name[:1] == 'C' and 1 <= num <= len(categorical_features):
+                    cols.append(len(numeric_features) + num - 1)
+                else:
+                    raise ValueError("invalid cross field %r in %r" % (name, crosses))
+            if len(cols) < 2:
+                raise ValueError("a cross needs at least 2 fields: %r" % cross)
+            self.crosses.append(cols)
+
+    def size(self):
+        return len(self.crosses) * self.buckets
+
+    def gen(self, feat_idx):
+        """
+        Return wide ids [rows, len(crosses)] of encoded feat_idx [rows, field_size].
+        """
+        wide_idx = np.empty((feat_idx.shape[0], len(self.crosses)), dtype=np.int64)
+        for k in range(0, len(self.crosses)):
+            hashes = np.full(feat_idx.shape[0], k + 1, dtype=np.uint64)
+            for j in self.crosses[k]:
+                hashes = _mix64(hashes ^ feat_idx[:, j].astype(np.uint64))
+            wide_idx[:, k] = (hashes % np.uint64(self.buckets)).astype(np.int64) + k * self.buckets
+        return wide_idx
+
+
+class KLLSketch:
+    """
+    Mergeable streaming quantile sketch (KLL). Level h keeps items of weight
+    2^h, a full level is sorted and every other item is promoted to the next
+    level. Memory is O(k*log(n/k)), rank error is about 1.7/k.
+    """
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0, dtype=np.int64)]
+        self.rand = random.Random(seed)
+
+    def _capacity(self, h):
+        return max(int(np.ceil(self.k * (2.0 / 3) ** (len(self.levels) - h - 1))), 2)
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if self.levels[h].size > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.int64))
+                level = np.sort(self.levels[h])
+                n = level.size // 2 * 2
+                # 奇数个元素时保留最大的一个在当前层
+                promoted = level[self.rand.randint(0, 1):n:2]
+                self.levels[h] = level[n:]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype=np.int64)])
+        self.count += len(values)
+        self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.int64))
+        for h in range(0, len(other.levels)):
+            self.levels[h] = np.concatenate([self.levels[h], other.levels[h]])
+        self.count += other.count
+        self._compress()
+
+    def quantile(self, q):
+        """
+        Return the (approximate) q-quantiles of the inserted values, q: float or array.
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 1 << h, dtype=np.int64)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cum = np.cumsum(weights[order])
+        pos = np.searchsorted(cum, np.asarray(q) * cum[-1], side='left')
+        return values[order][np.minimum(pos, values.size - 1)]
+
 
 class NumericFeatureGenerator:
     """
     Normalize the numeric features to [0, 1] by min-max normalization
     """
 
-    def __init__(self, num_feature):
+    def __init__(self, num_feature, clip_quantile=0.0, num_buckets=0, kll_k=200):
         self.num_feature = num_feature
         self.min = [sys.maxsize] * num_feature
         self.max = [-sys.maxsize] * num_feature
+        self.clip_quantile = clip_quantile
+        self.num_buckets = num_buckets
+        self.kll_k = kll_k
+        # 分位数sketch: 按数据分位数确定截断阈值/分桶边界
+        self.sketches = None
+        self.clip = list(numeric_clip)
+        if clip_quantile > 0 or num_buckets > 0:
+            self.sketches = [KLLSketch(kll_k, seed=i) for i in range(0, num_feature)]
+        if clip_quantile > 0:
+            # 阈值未知时先统计原始min/max, finalize时再截断
+            self.clip = [sys.maxsize] * num_feature
+        self.bounds = None
 
     def build(self, datafile, numeric_feature):
+        # 返回统计的行数
+        rows = 0
         with open(datafile, 'r') as f:
             for line in f:
                 features = line.rstrip('\n').split('\t')
-                for i in range(0, self.num_feature):
-                    val = features[numeric_feature[i]]
-                    if val != '':
-                        val = int(val)
-                        if val > numeric_clip[i]:
-                            val = numeric_clip[i]
-                        self.min[i] = min(self.min[i], val)
-                        self.max[i] = max(self.max[i], val)
+                self.update(features, numeric_feature)
+                rows += 1
+        return rows
+
+    def update(self, features, numeric_feature):
+        for i in range(0, self.num_feature):
+            val = features[numeric_feature[i]]
+            if val != '':
+                val = int(val)
+                if self.sketches is not None:
+                    self.sketches[i].update([val])
+                if val > self.clip[i]:
+                    val = self.clip[i]
+                if val < self.min[i]:
+                    self.min[i] = val
+                if val > self.max[i]:
+                    self.max[i] = val
+
+    def merge(self, other):
+        for i in range(0, self.num_feature):
+            self.min[i] = min(self.min[i], other.min[i])
+            self.max[i] = max(self.max[i], other.max[i])
+            if self.sketches is not None:
+                self.sketches[i].merge(other.sketches[i])
+
+    def new_shard(self):
+        return NumericFeatureGenerator(self.num_feature, self.clip_quantile, self.num_buckets, self.kll_k)
+
+    def finalize(self):
+        if self.sketches is None:
+            return
+        for i in range(0, self.num_feature):
+            if self.sketches[i].count == 0:
+                continue
+            if self.clip_quantile > 0:
+                # min(clip(x)) = min(min(x), clip), max同理, 因此可以在统计之后再截断
+                self.clip[i] = int(self.sketches[i].quantile(self.clip_quantile))
+                self.min[i] = min(self.min[i], self.clip[i])
+                self.max[i] = min(self.max[i], self.clip[i])
+        if self.num_buckets > 0:
+            # 等频分桶边界, 桶编号: 0为缺失值, 1..len(bounds)+1
+            qs = np.arange(1, self.num_buckets) / float(self.num_buckets)
+            self.bounds = [np.unique(sketch.quantile(qs)).tolist() if sketch.count > 0 else []
+                           for sketch in self.sketches]
+            self.offset = np.cumsum([0] + self.dicts_sizes()).tolist()
+
+    def dicts_sizes(self):
+        # 每个数值特征占用的特征编号数
+        if self.bounds is None:
+            return [1] * self.num_feature
+        return [len(bounds) + 2 for bounds in self.bounds]
 
     def gen(self, idx, val):
         if val == '':
             return 0.0
         val = float(val)
+        if self.clip_quantile > 0:
+            val = min(val, self.clip[idx])
         return (val - self.min[idx]) / (self.max[idx] - self.min[idx])
 
+    def bucket(self, idx, val):
+        """
+        Return the quantile bucket of val, 0 for missing value.
+        """
+        if val == '':
+            return 0
+        return int(np.searchsorted(self.bounds[idx], int(val), side='right')) + 1
+
+
+def split_file(datafile, num_chunks):
+    """
+    Split datafile into at most num_chunks byte ranges [start, end),
+    every range boundary is aligned to the beginning of a line.
+    """
+    size = os.path.getsize(datafile)
+    bounds = [0]
+    with open(datafile, 'rb') as f:
+        for i in range(1, num_chunks):
+            pos = size * i // num_chunks
+            if pos <= bounds[-1]:
+                continue
+            # 移动到pos所在行的行尾, 保证每个分片都是完整的行
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_lines(datafile, start=0, end=None):
+    """
+    Yield the lines of datafile in byte range [start, end) without line breaks.
+    """
+    with open(datafile, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('utf-8').rstrip('\r\n')
+
+
+def read_blocks(datafile, start=0, end=None, block_size=1 << 23):
+    """
+    Yield byte blocks of whole lines in byte range [start, end) of datafile,
+    each block is about block_size bytes.
+    """
+    if end is None:
+        end = os.path.getsize(datafile)
+    with open(datafile, 'rb') as f:
+        f.seek(start)
+        remain = end - start
+        tail = b''
+        while remain > 0:
+            data = f.read(min(block_size, remain))
+            if not data:
+                break
+            remain -= len(data)
+            data = tail + data
+            cut = len(data) if remain <= 0 else data.rfind(b'\n') + 1
+            tail = data[cut:]
+            if cut > 0:
+                yield data[:cut]
+        if tail:
+            yield tail
+
+
+def follow_blocks(path, block_size=1 << 20, poll_sec=1.0, idle_sec=0.0, num_cols=0):
+    """
+    Yield byte blocks of whole lines read from stdin(path '-') or from a file
+    that may still be growing. At the end of a file keep polling every poll_sec
+    until no new data arrives for idle_sec seconds(idle_sec < 0: forever).
+    A last line without line break is yielded only if it has num_cols fields,
+    otherwise it is a row still being written and is skipped.
+    While waiting for data an empty block b'' is yielded every poll_sec, so the
+    caller can act on time limits(stdin only on POSIX, where it can be polled).
+    """
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    tail = b''
+    idle = 0.0
+    try:
+        while True:
+            if path == '-' and os.name != 'nt':
+                # 不经过缓冲直接读取stdin, select超时表示暂时没有新数据
+                if not select.select([f], [], [], poll_sec)[0]:
+                    yield b''
+                    continue
+                data = os.read(f.fileno(), block_size)
+            else:
+                data = f.read1(block_size) if path == '-' else f.read(block_size)
+            if not data:
+                if path == '-' or 0 <= idle_sec <= idle:
+                    break
+                # 文件暂时没有新数据, 等待写入
+                time.sleep(poll_sec)
+                idle += poll_sec
+                yield b''
+                continue
+            idle = 0.0
+            data = tail + data
+            cut = data.rfind(b'\n') + 1
+            tail = data[cut:]
+            if cut > 0:
+                yield data[:cut]
+        if tail and (num_cols <= 0 or tail.count(b'\t') + 1 == num_cols):
+            yield tail
+        elif tail:
+            print("skipped unterminated last line of %d bytes" % len(tail))
+    finally:
+        if path != '-':
+            f.close()
+
+
+class TsvBlock:
+    """
+    A block of raw TSV rows parsed with NumPy. Field boundaries are located
+    on the raw bytes once, columns are decoded only when requested.
+    """
+
+    # 缓冲区首尾各补齐的字节数, 按字节取字段时无需做越界检查
+    PAD = 32
+
+    def __init__(self, data, num_cols):
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        pad = b'\0' * self.PAD
+        self.buf = np.frombuffer(pad + data + pad, dtype=np.uint8)
+        ends = np.flatnonzero((self.buf == 9) | (self.buf == 10))
+        seps = self.buf[ends]
+        if ends.size % num_cols != 0 or np.any(seps[num_cols-1::num_cols] != 10) or \
+                np.count_nonzero(seps == 10) != ends.size // num_cols:
+            raise ValueError("Malformed block: every row should have %d columns" % num_cols)
+        starts = np.empty_like(ends)
+        starts[0] = self.PAD
+        starts[1:] = ends[:-1] + 1
+        self.starts = starts.reshape(-1, num_cols)
+        self.ends = ends.reshape(-1, num_cols)
+        # '\r\n' line endings
+        last = self.ends[:, -1]
+        is_cr = (last > self.starts[:, -1]) & (self.buf[last - 1] == 13)
+        if np.any(is_cr):
+            self.ends[:, -1] = last - is_cr
+        self.num_rows = self.ends.shape[0]
+
+    def lines(self):
+        # 每行的原始字节(不含行尾换行符)
+        raw = self.buf.tobytes()
+        return [raw[s:e] for s, e in zip(self.starts[:, 0].tolist(), self.ends[:, -1].tolist())]
+
+    def _gather(self, j, width, right=False):
+        # 把第j列的每个字段按字节取出, 对齐为[rows, width], 不足部分补0
+        starts, ends = self.starts[:, j], self.ends[:, j]
+        lens = ends - starts
+        offs = np.arange(width)
+        if right:
+            pos = ends[:, None] - width + offs
+            valid = offs >= (width - lens)[:, None]
+        else:
+            pos = starts[:, None] + offs
+            valid = offs < lens[:, None]
+        if width > self.PAD:
+            pos = np.clip(pos, 0, self.buf.size - 1)
+        chars = self.buf.take(pos)
+        chars[~valid] = 0
+        return chars, lens, valid
+
+    def lengths(self, j):
+        return self.ends[:, j] - self.starts[:, j]
+
+    def bytes_column(self, j):
+        """
+        Return column j as a fixed-width bytes array, missing value is b''.
+        """
+        width = max(int(self.lengths(j).max()), 1)
+        chars, _, _ = self._gather(j, width)
+        return chars.view('S%d' % width).reshape(-1)
+
+    def str_column(self, j):
+        """
+        Return column j as an object array of str.
+        """
+        keys, inverse = np.unique(self.bytes_column(j), return_inverse=True)
+        keys = np.array([key.decode('utf-8') for key in keys.tolist()], dtype=object)
+        return keys[inverse.reshape(-1)]
+
+    def int_column(self, j):
+        """
+        Return column j parsed as int64 and the mask of non-missing values.
+        """
+        lens = self.lengths(j)
+        mask = lens > 0
+        values = np.zeros(self.num_rows, dtype=np.int64)
+        width = int(lens.max())
+        if width == 0:
+            return values, mask
+        chars, lens, valid = self._gather(j, width, right=True)
+        digits = chars.astype(np.int64) - 48
+        digits[~valid] = 0
+        neg = mask & (self.buf[self.starts[:, j]] == 45)        # '-'
+        digits[np.flatnonzero(neg), (width - lens)[neg]] = 0
+        if width > 18 or np.any((digits < 0) | (digits > 9)) or np.any(neg & (lens == 1)):
+            # 非常规整数格式, 逐个交给int()解析
+            values[mask] = [int(x) for x in self.bytes_column(j)[mask].tolist()]
+            return values, mask
+        values = digits.dot(10 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+        values[neg] = -values[neg]
+        return values, mask
+
+
+def unique_keys(col, return_inverse=False, return_counts=False):
+    """
+    np.unique for fixed-width bytes columns, 8-byte keys (hashed Criteo
+    values) are compared as uint64 which is much faster than bytes sorting.
+    """
+    if col.dtype.itemsize == 8:
+        res = np.unique(col.view(np.uint64), return_inverse=return_inverse, return_counts=return_counts)
+        if isinstance(res, tuple):
+            return (res[0].view(col.dtype),) + tuple(r.reshape(-1) for r in res[1:])
+        return res.view(col.dtype)
+    res = np.unique(col, return_inverse=return_inverse, return_counts=return_counts)
+    if isinstance(res, tuple):
+        return (res[0],) + tuple(r.reshape(-1) for r in res[1:])
+    return res
+
+
+class StageReport:
+    """
+    Wall time, rows/s and MB/s of each preprocessing stage, peak RSS and
+    other statistics, saved as a JSON report.
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.stages = []
+        self.info = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        # 在with语句内设置stage["rows"]
+        stage = collections.OrderedDict([("stage", name), ("rows", 0), ("bytes", nbytes)])
+        start = time.time()
+        yield stage
+        seconds = max(time.time() - start, 1e-9)
+        stage["seconds"] = round(seconds, 3)
+        stage["rows_per_sec"] = round(stage["rows"] / seconds, 1)
+        stage["mb_per_sec"] = round(stage["bytes"] / seconds / (1 << 20), 2)
+        stage["peak_rss_mb"] = peak_rss_mb()
+        self.stages.append(stage)
+        if self.verbose:
+            print("---- %-16s %8.2fs %10d rows %10.0f rows/s %8.2f MB/s, peak RSS %s MB" % (
+                name, seconds, stage["rows"], stage["rows_per_sec"], stage["mb_per_sec"], stage["peak_rss_mb"]))
+
+    def save(self, path):
+        report = collections.OrderedDict([("stages", self.stages),
+                                          ("total_seconds", round(sum(s["seconds"] for s in self.stages), 3)),
+                                          ("peak_rss_mb", peak_rss_mb())])
+        report.update(self.info)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size(MB) of this process and of the finished worker processes.
+    """
+    if resource is None:
+        return None
+    # Linux下单位为KB, macOS下为字节
+    unit = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / float(unit), 1)
+
+
+def collect_statistics(lines, n_feat, c_feat):
+    """
+    Collect numeric min/max and categorical counts of lines into n_feat/c_feat,
+    each line is split only once and shared by both generators.
+    Return the number of lines.
+    """
+    n_min, n_max = n_feat.min, n_feat.max
+    rows = 0
+    if n_feat.sketches is not None:
+        for line in lines:
+            features = line.split('\t')
+            n_feat.update(features, numeric_features)
+            c_feat.update(features, categorical_features)
+            rows += 1
+        return rows
+    n_cols = list(zip(range(0, n_feat.num_feature), numeric_features, n_feat.clip))
+    c_cols = list(zip(c_feat.dicts, categorical_features))
+    for line in lines:
+        rows += 1
+        features = line.split('\t')
+        for i, col, clip in n_cols:
+            val = features[col]
+            if val != '':
+                val = int(val)
+                if val > clip:
+                    val = clip
+                if val < n_min[i]:
+                    n_min[i] = val
+                if val > n_max[i]:
+                    n_max[i] = val
+        for counts, col in c_cols:
+            key = features[col]
+            if key != '':
+                counts[key] += 1
+    return rows
+
+
+def collect_statistics_block(block, n_feat, c_feat):
+    """
+    Column-wise version of collect_statistics for a TsvBlock.
+    """
+    for i in range(0, n_feat.num_feature):
+        val, mask = block.int_column(numeric_features[i])
+        if np.any(mask):
+            if n_feat.sketches is not None:
+                n_feat.sketches[i].update(val[mask])
+            val = np.minimum(val[mask], n_feat.clip[i])
+            n_feat.min[i] = min(n_feat.min[i], int(val.min()))
+            n_feat.max[i] = max(n_feat.max[i], int(val.max()))
+    if not c_feat.counting:
+        return block.num_rows
+    for i in range(0, c_feat.num_feature):
+        col = block.bytes_column(categorical_features[i])
+        keys, cnts = unique_keys(col[col != b''], return_counts=True)
+        c_feat.add_counts(i, keys, cnts)
+    return block.num_rows
+
+
+def scan_statistics(datafile, n_feat, c_feat, start=0, end=None, engine="numpy"):
+    """
+    Collect statistics of byte range [start, end) of datafile in one scan,
+    return the number of rows.
+    """
+    rows = 0
+    if engine == "numpy":
+        num_cols = 1 + len(numeric_features) + len(categorical_features)
+        for data in read_blocks(datafile, start, end):
+            rows += collect_statistics_block(TsvBlock(data, num_cols), n_feat, c_feat)
+    else:
+        rows = collect_statistics(read_lines(datafile, start, end), n_feat, c_feat)
+    return rows
+
+
+def build_statistics(datafile, n_feat, c_feat, cutoff=0, engine="python", report=None):
+    """
+    Collect numeric min/max and categorical counts in one scan of datafile.
+    """
+    report = report if report is not None else StageReport(verbose=False)
+    with report.stage("count", os.path.getsize(datafile)) as stage:
+        if engine == "numpy":
+            stage["rows"] = scan_statistics(datafile, n_feat, c_feat, engine=engine)
+        else:
+            with open(datafile, 'r') as f:
+                stage["rows"] = collect_statistics((line.rstrip('\n') for line in f), n_feat, c_feat)
+    with report.stage("finalize"):
+        n_feat.finalize()
+        c_feat.finalize(cutoff)
+
+
+def _statistics_worker(task):
+    datafile, start, end, engine, n_feat, c_feat = task
+    rows = scan_statistics(datafile, n_feat, c_feat, start, end, engine)
+    return n_feat, c_feat, rows
+
+
+def build_statistics_parallel(datafile, n_feat, c_feat, cutoff=0, threads=2, engine="python", report=None):
+    """
+    Split datafile into byte-range chunks, collect statistics of each chunk
+    in a worker process and merge them into n_feat/c_feat.
+    """
+    report = report if report is not None else StageReport(verbose=False)
+    chunks = split_file(datafile, threads)
+    tasks = [(datafile, start, end, engine, n_feat.new_shard(), c_feat.new_shard(len(chunks)))
+             for start, end in chunks]
+    with report.stage("count", os.path.getsize(datafile)) as stage:
+        pool = multiprocessing.Pool(threads)
+        try:
+            # 按分片顺序合并, 保证分位数sketch的结果可复现
+            for chunk_n, chunk_c, rows in pool.imap(_statistics_worker, tasks):
+                n_feat.merge(chunk_n)
+                c_feat.merge(chunk_c)
+                stage["rows"] += rows
+        finally:
+            pool.close()
+            pool.join()
+    with report.stage("finalize"):
+        n_feat.finalize()
+        c_feat.finalize(cutoff)
+
+
+def encode_row(features, n_feat, c_feat, c_feat_offset, shift=0):
+    """
+    Encode one raw row as (feat_idx, feat_val) lists, shift is the column offset
+    of the row (-1 for test.txt which has no label column).
+    """
+    feat_idx, feat_val = [], []
+    # numeric features normalized to [0,1], or bucketized as categorical ids
+    for i in range(0, len(numeric_features)):
+        if n_feat.bounds is not None:
+            feat_idx.append(n_feat.bucket(i, features[numeric_features[i] + shift]) + n_feat.offset[i] + 1)
+            feat_val.append(1.0)
+            continue
+        feat_idx.append(numeric_features[i])
+        feat_val.append(n_feat.gen(i, features[numeric_features[i] + shift]))
+
+    # categorical features one-hot embedding
+    for i in range(0, len(categorical_features)):
+        feat_idx.append(c_feat.gen(i, features[categorical_features[i] + shift]) + c_feat_offset[i] + 1)
+        feat_val.append(1.0)
+    return feat_idx, feat_val
+
+
+def encode_block(block, n_feat, c_feat, c_feat_offset, shift=0):
+    """
+    Column-wise version of encode_row for a TsvBlock,
+    return feat_idx/feat_val as [rows, field_size] NumPy arrays.
+    """
+    num_n = len(numeric_features)
+    num_c = len(categorical_features)
+    feat_idx = np.empty((block.num_rows, num_n + num_c), dtype=np.int64)
+    feat_val = np.ones((block.num_rows, num_n + num_c), dtype=np.float64)
+    # numeric features normalized to [0,1], missing value is 0
+    for i in range(0, num_n):
+        val, mask = block.int_column(numeric_features[i] + shift)
+        if n_feat.bounds is not None:
+            bucket = np.searchsorted(np.asarray(n_feat.bounds[i], dtype=np.int64), val, side='right') + 1
+            feat_idx[:, i] = np.where(mask, bucket, 0) + n_feat.offset[i] + 1
+            continue
+        if n_feat.clip_quantile > 0:
+            val = np.minimum(val, n_feat.clip[i])
+        feat_idx[:, i] = numeric_features[i]
+        feat_val[:, i] = 0.0
+        feat_val[mask, i] = (val[mask].astype(np.float64) - n_feat.min[i]) / (n_feat.max[i] - n_feat.min[i])
+
+    # categorical features one-hot embedding, lookup once per distinct value
+    for i in range(0, num_c):
+        keys, inverse = unique_keys(block.bytes_column(categorical_features[i] + shift), return_inverse=True)
+        ids = c_feat.lookup(i, keys)
+        feat_idx[:, num_n + i] = ids[inverse] + c_feat_offset[i] + 1
+    return feat_idx, feat_val
+
+
+def format_value(v):
+    return "{0:.6f}".format(v).rstrip('0').rstrip('.')
+
+
+def format_block(labels, feat_idx, feat_val, weights=None, wide_idx=None):
+    """
+    Format encoded rows as text lines 'label idx:val ...', byte-identical to
+    the original line-by-line output. Every column is formatted once per distinct idx/val.
+    With weights the first token is 'label:weight', wide cross ids are appended as plain ints.
+    """
+    num_rows, num_cols = feat_idx.shape
+    if num_rows == 0:
+        return ''
+    num_wide = 0 if wide_idx is None else wide_idx.shape[1]
+    tokens = np.empty((num_rows, num_cols + 1 + num_wide), dtype=object)
+    tokens[:, 0] = labels
+    if weights is not None:
+        wgt_keys, wgt_inv = np.unique(weights, return_inverse=True)
+        tokens[:, 0] += np.array([':' + format_value(w) for w in wgt_keys.tolist()], dtype=object)[wgt_inv]
+    for j in range(0, num_cols):
+        idx_keys, idx_inv = np.unique(feat_idx[:, j], return_inverse=True)
+        val_keys, val_inv = np.unique(feat_val[:, j], return_inverse=True)
+        idx_strs = [str(k) + ':' for k in idx_keys.tolist()]
+        val_strs = [format_value(v) for v in val_keys.tolist()]
+        if len(idx_strs) == 1:
+            tokens[:, j + 1] = np.array([idx_strs[0] + v for v in val_strs], dtype=object)[val_inv.reshape(-1)]
+        elif len(val_strs) == 1:
+            tokens[:, j + 1] = np.array([k + val_strs[0] for k in idx_strs], dtype=object)[idx_inv.reshape(-1)]
+        else:
+            tokens[:, j + 1] = np.array(idx_strs, dtype=object)[idx_inv.reshape(-1)] +\
+                               np.array(val_strs, dtype=object)[val_inv.reshape(-1)]
+    for k in range(0, num_wide):
+        tokens[:, num_cols + 1 + k] = wide_idx[:, k].astype(str).astype(object)
+    return '\n'.join(map(' '.join, tokens.tolist())) + '\n'
+
+
+class NpyWriter:
+    """
+    Append rows to a .npy file whose row count is unknown until close,
+    a fixed-size header is reserved and rewritten with the final shape.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.f = open(path, 'wb')
+        self.f.write(b'\0' * self.HEADER_SIZE)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+
+    def write(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        self.f.write(arr.tobytes())
+        self.rows += arr.shape[0]
+
+    def close(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(self.dtype), (self.rows,) + self.row_shape)
+        # magic(6) + version(2) + header_len(2) + header, 以'\n'结尾
+        header = header.ljust(self.HEADER_SIZE - 11) + '\n'
+        self.f.seek(0)
+        self.f.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+        self.f.close()
+
+
+class TextSink:
+    """
+    Write encoded blocks as text lines 'label idx:val ... [wide ids]' to {prefix}.set
+    """
+
+    def __init__(self, prefix, crosser=None):
+        self.f = open(prefix + ".set", 'w')
+        self.crosser = crosser
+
+    def write(self, labels, feat_idx, feat_val, weights=None):
+        wide_idx = None if self.crosser is None else self.crosser.gen(feat_idx)
+        self.f.write(format_block(labels, feat_idx, feat_val, weights, wide_idx))
+
+    def close(self):
+        self.f.close()
+
+
+class NpySink:
+    """
+    Write encoded blocks as fixed-width binary columns: {prefix}.idx.npy int32
+    [rows, field_size], {prefix}.val.npy float32 [rows, field_size] and
+    {prefix}.lbl.npy float32 [rows], which can be memory-mapped by the reader.
+    Weighted outputs also have {prefix}.wgt.npy float32 [rows],
+    wide crosses {prefix}.wide.npy int32 [rows, len(crosses)].
+    """
+
+    def __init__(self, prefix, crosser=None):
+        field_size = len(numeric_features) + len(categorical_features)
+        self.prefix = prefix
+        self.idx = NpyWriter(prefix + ".idx.npy", np.int32, (field_size,))
+        self.val = NpyWriter(prefix + ".val.npy", np.float32, (field_size,))
+        self.lbl = NpyWriter(prefix + ".lbl.npy", np.float32)
+        self.wgt = None
+        self.crosser = crosser
+        if crosser is not None:
+            self.wide = NpyWriter(prefix + ".wide.npy", np.int32, (len(crosser.crosses),))
+
+    def write(self, labels, feat_idx, feat_val, weights=None):
+        self.idx.write(feat_idx)
+        self.val.write(feat_val)
+        self.lbl.write(labels.astype(np.float32))
+        if self.crosser is not None:
+            self.wide.write(self.crosser.gen(feat_idx))
+        if weights is not None:
+            if self.wgt is None:
+                self.wgt = NpyWriter(self.prefix + ".wgt.npy", np.float32)
+            self.wgt.write(weights.astype(np.float32))
+
+    def close(self):
+        self.idx.close()
+        self.val.close()
+        self.lbl.close()
+        if self.wgt is not None:
+            self.wgt.close()
+        if self.crosser is not None:
+            self.wide.close()
+
+
+class TFRecordSink:
+    """
+    Write encoded blocks as tf.train.Example records to {prefix}.tfrecord,
+    feat_idx int64 [field_size], feat_val float32 [field_size], label float32
+    weight float32 for weighted outputs and wide_idx int64 [len(crosses)].
+    compression: '' | 'GZIP' | 'ZLIB'
+    """
+
+    def __init__(self, prefix, compression="", crosser=None):
+        import tensorflow as tf        # 只有输出TFRecord时才需要TensorFlow
+        self.tf = tf
+        self.crosser = crosser
+        options = tf.io.TFRecordOptions(compression) if compression else None
+        self.writer = tf.io.TFRecordWriter(prefix + ".tfrecord", options)
+
+    def write(self, labels, feat_idx, feat_val, weights=None):
+        tf = self.tf
+        feat_val = feat_val.astype(np.float32)
+        wgts = [None] * len(labels) if weights is None else weights.astype(np.float32).tolist()
+        wides = [None] * len(labels) if self.crosser is None else self.crosser.gen(feat_idx).tolist()
+        for label, idx, val, wgt, wide in zip(labels.astype(np.float32).tolist(), feat_idx.tolist(),
+                                              feat_val.tolist(), wgts, wides):
+            feature = {
+                "feat_idx": tf.train.Feature(int64_list=tf.train.Int64List(value=idx)),
+                "feat_val": tf.train.Feature(float_list=tf.train.FloatList(value=val)),
+                "label": tf.train.Feature(float_list=tf.train.FloatList(value=[label]))}
+            if wgt is not None:
+                feature["weight"] = tf.train.Feature(float_list=tf.train.FloatList(value=[wgt]))
+            if wide is not None:
+                feature["wide_idx"] = tf.train.Feature(int64_list=tf.train.Int64List(value=wide))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            self.writer.write(example.SerializeToString())
+
+    def close(self):
+        self.writer.close()
+
+
+def pack_records(labels, feat_idx, feat_val, weights=None):
+    """
+    Pack encoded rows as fixed-width float64 records for temp bucket files:
+    feat_idx(int64 bits), feat_val, label, weight(NaN if the rows have no weights).
+    """
+    num_rows, num_cols = feat_idx.shape
+    records = np.empty((num_rows, 2 * num_cols + 2), dtype=np.float64)
+    records[:, :num_cols] = feat_idx.astype(np.int64).view(np.float64)
+    records[:, num_cols:2 * num_cols] = feat_val
+    records[:, -2] = labels.astype(np.float64)
+    records[:, -1] = np.nan if weights is None else weights
+    return records
+
+
+class CollapseSink:
+    """
+    Merge rows with identical encoded feat_idx/feat_val into one example with
+    soft label clicks/impressions and weight impressions(weighted sums if the
+    rows already have weights), then write them to sink. The loss of the merged
+    example equals the summed loss of the original rows, so the optimum is kept.
+    Rows are scattered into num_buckets temp files by a hash of the encoded row,
+    and each bucket is merged in memory on close, in order of first occurrence.
+    """
+
+    def __init__(self, sink, num_buckets=1, tmp_dir=None):
+        self.sink = sink
+        self.num_buckets = num_buckets
+        self.tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+        self.buckets = [open(os.path.join(self.tmp_dir, "bucket-%05d" % b), 'wb') for b in range(0, num_buckets)]
+        self.num_cols = 0
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def write(self, labels, feat_idx, feat_val, weights=None):
+        num_rows, self.num_cols = feat_idx.shape
+        if num_rows == 0:
+            return
+        self.rows_in += num_rows
+        if weights is None:
+            weights = np.ones(num_rows, dtype=np.float64)
+        records = pack_records(labels, feat_idx, feat_val, weights)
+        hashes = np.zeros(num_rows, dtype=np.uint64)
+        for j in range(0, 2 * self.num_cols):
+            hashes = _mix64(hashes ^ records[:, j].view(np.uint64))
+        bucket = (hashes % np.uint64(self.num_buckets)).astype(np.int64)
+        for b in np.unique(bucket).tolist():
+            self.buckets[b].write(records[bucket == b].tobytes())
+
+    def close(self):
+        try:
+            for f in self.buckets:
+                f.close()
+            for f in self.buckets:
+                records = np.fromfile(f.name, dtype=np.float64)
+                os.remove(f.name)
+                if records.size == 0:
+                    continue
+                records = records.reshape(-1, 2 * self.num_cols + 2)
+                # 按编码后的整行字节去重
+                keys = np.ascontiguousarray(records[:, :-2]).view(
+                    np.dtype((np.void, 16 * self.num_cols))).ravel()
+                _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+                inverse = inverse.reshape(-1)
+                impressions = np.bincount(inverse, weights=records[:, -1])
+                clicks = np.bincount(inverse, weights=records[:, -1] * records[:, -2])
+                order = np.argsort(first, kind='stable')
+                rows = records[first[order]]
+                labels = np.array([format_value(v) for v in (clicks / impressions)[order].tolist()], dtype=object)
+                feat_idx = rows[:, :self.num_cols].view(np.int64)
+                feat_val = rows[:, self.num_cols:2 * self.num_cols]
+                self.sink.write(labels, feat_idx, feat_val, impressions[order])
+                self.rows_out += len(order)
+        finally:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.sink.close()
+        print("collapsed %d rows into %d weighted examples" % (self.rows_in, self.rows_out))
+
+
+class ScatterSink:
+    """
+    First pass of the external shuffle of encoded rows(binary outputs): scatter
+    every row uniformly at random into one of num_buckets temp files
+    {tmp_dir}/bucket-xxxxx{suffix}. gather_buckets() is the second pass.
+    """
+
+    def __init__(self, tmp_dir, suffix, num_buckets, seed=0):
+        self.rand = np.random.RandomState((seed + zlib.crc32(suffix.encode('utf-8'))) & 0xffffffff)
+        self.num_buckets = num_buckets
+        self.buckets = [open(os.path.join(tmp_dir, "bucket-%05d%s" % (b, suffix)), 'wb')
+                        for b in range(0, num_buckets)]
+
+    def write(self, labels, feat_idx, feat_val, weights=None):
+        if feat_idx.shape[0] == 0:
+            return
+        records = pack_records(labels, feat_idx, feat_val, weights)
+        bucket = self.rand.randint(0, self.num_buckets, size=records.shape[0])
+        for b in np.unique(bucket).tolist():
+            self.buckets[b].write(records[bucket == b].tobytes())
+
+    def close(self):
+        for f in self.buckets:
+            f.close()
+
+
+def gather_buckets(tmp_dir, num_buckets, prefixes, out_format="text", compression="", crosser=None, seed=0):
+    """
+    Second pass of the external shuffle: shuffle each bucket of ScatterSink(all
+    shards) in memory and write the buckets in turn to the outputs prefixes,
+    num_buckets is a multiple of len(prefixes) so every output gets the same
+    number of buckets. Return the number of rows.
+    """
+    num_cols = len(numeric_features) + len(categorical_features)
+    rand = np.random.RandomState(seed)
+    sinks = [open_sink(prefix, out_format, compression, crosser) for prefix in prefixes]
+    rows = 0
+    try:
+        for b in range(0, num_buckets):
+            files = sorted(glob.glob(os.path.join(tmp_dir, "bucket-%05d*" % b)))
+            records = np.concatenate([np.fromfile(f, dtype=np.float64) for f in files]).reshape(-1, 2 * num_cols + 2)
+            for f in files:
+                os.remove(f)
+            if records.shape[0] == 0:
+                continue
+            rand.shuffle(records)
+            labels = np.array([format_value(v) for v in records[:, -2].tolist()], dtype=object)
+            weights = None if np.isnan(records[:, -1]).all() else records[:, -1]
+            sinks[b * len(prefixes) // num_buckets].write(labels, records[:, :num_cols].view(np.int64),
+                                                          records[:, num_cols:2 * num_cols], weights)
+            rows += records.shape[0]
+    finally:
+        for sink in sinks:
+            sink.close()
+    return rows
+
+
+def open_sink(prefix, out_format="text", compression="", crosser=None):
+    if out_format == "npy":
+        return NpySink(prefix, crosser)
+    if out_format == "tfrecord":
+        return TFRecordSink(prefix, compression, crosser)
+    return TextSink(prefix, crosser)
+
+
+class RandomSplit:
+    """
+    90%/10% train/valid split by a seeded random sequence, one draw per row,
+    so the assignment depends on the row order.
+    """
+
+    def __init__(self, seed=0):
+        self.rand = random.Random(seed)
+
+    def block_mask(self, block):
+        return np.array([self.rand.randint(0, 9999) % 10 != 0 for _ in range(block.num_rows)], dtype=bool)
+
+
+class HashSplit:
+    """
+    90%/10% train/valid split keyed on crc32 of the raw line, the assignment
+    of a row is the same whichever chunk or worker processes it.
+    """
+
+    def block_mask(self, block):
+        return np.array([zlib.crc32(line) % 10 != 0 for line in block.lines()], dtype=bool)
+
+
+class NegativeSampler:
+    """
+    Keep every positive row and a fraction rate of the negative rows, kept
+    negatives get the importance weight 1/rate. The decision is keyed on a
+    hash of the raw line, so it is the same for any chunk or worker.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def sample(self, batch, labels):
+        # crc32再经过splitmix64打散, 与train/valid划分(crc32 % 10)相互独立
+        crcs = np.array([zlib.crc32(line) for line in batch.lines()], dtype=np.uint64)
+        uniform = (_mix64(crcs) >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+        positive = labels != '0'
+        keep = positive | (uniform < self.rate)
+        weights = np.where(positive, 1.0, 1.0 / self.rate).astype(np.float32)
+        return keep, weights
+
+
+def make_split(mode, seed=0):
+    if mode == "hash":
+        return HashSplit()
+    return RandomSplit(seed)
+
+
+class LineBatch:
+    """
+    A batch of raw rows already split into lines, the line-by-line counterpart of TsvBlock.
+    """
+
+    def __init__(self, lines):
+        self.raw = lines
+        self.num_rows = len(lines)
+
+    def lines(self):
+        return [line.encode('utf-8') for line in self.raw]
+
+
+def iter_batches(datafile, kind, n_feat, c_feat, c_feat_offset, start=0, end=None, engine="numpy",
+                 batch_size=8192):
+    """
+    Read byte range [start, end) of datafile and yield encoded batches
+    (batch, labels, feat_idx, feat_val): batch is the TsvBlock/LineBatch of
+    the raw rows, labels are strings, feat_idx/feat_val are [rows, field_size].
+    The infer set(test.txt) has no label column, its fake label is '0'.
+    """
+    shift = -1 if kind == "infer" else 0
+    if engine == "numpy":
+        # 按数据块列式处理
+        for data in read_blocks(datafile, start, end):
+            yield encode_data(data, kind, n_feat, c_feat, c_feat_offset)
+        return
+
+    # 逐行处理
+    lines = []
+    for line in read_lines(datafile, start, end):
+        lines.append(line)
+        if len(lines) < batch_size:
+            continue
+        yield _encode_lines(lines, kind, n_feat, c_feat, c_feat_offset, shift)
+        lines = []
+    if lines:
+        yield _encode_lines(lines, kind, n_feat, c_feat, c_feat_offset, shift)
+
+
+def encode_data(data, kind, n_feat, c_feat, c_feat_offset):
+    """
+    Parse and encode a byte block of whole raw lines, return (block, labels, feat_idx, feat_val).
+    """
+    shift = -1 if kind == "infer" else 0
+    block = TsvBlock(data, 1 + len(numeric_features) + len(categorical_features) + shift)
+    feat_idx, feat_val = encode_block(block, n_feat, c_feat, c_feat_offset, shift)
+    if kind == "infer":
+        labels = np.full(block.num_rows, '0', dtype=object)      # test fake label
+    else:
+        labels = block.str_column(0)
+    return block, labels, feat_idx, feat_val
+
+
+def _encode_lines(lines, kind, n_feat, c_feat, c_feat_offset, shift):
+    rows = [line.split('\t') for line in lines]
+    encoded = [encode_row(features, n_feat, c_feat, c_feat_offset, shift) for features in rows]
+    if kind == "infer":
+        labels = np.full(len(rows), '0', dtype=object)
+    else:
+        labels = np.array([features[0] for features in rows], dtype=object)
+    feat_idx = np.array([idx for idx, _ in encoded], dtype=np.int64)
+    feat_val = np.array([val for _, val in encoded], dtype=np.float64)
+    return LineBatch(lines), labels, feat_idx, feat_val
+
+
+def transform_file(datafile, kind, n_feat, c_feat, c_feat_offset, out_train, out_valid=None, split=None,
+                   start=0, end=None, engine="numpy", sampler=None):
+    """
+    Transform byte range [start, end) of datafile and write the encoded batches
+    to sinks. For kind 'train' rows are split into out_train/out_valid by split,
+    other kinds are all written to out_train. The train rows are negative
+    downsampled and weighted by sampler if given.
+    Return (rows, seconds spent in the sinks, i.e. formatting and writing).
+    """
+    rows, write_sec = 0, 0.0
+    for batch, labels, feat_idx, feat_val in iter_batches(datafile, kind, n_feat, c_feat, c_feat_offset,
+                                                          start, end, engine):
+        rows += batch.num_rows
+        start_sec = time.time()
+        if kind == "train":
+            is_train = split.block_mask(batch)
+            if sampler is None:
+                out_train.write(labels[is_train], feat_idx[is_train], feat_val[is_train])
+            else:
+                keep, weights = sampler.sample(batch, labels)
+                keep &= is_train
+                out_train.write(labels[keep], feat_idx[keep], feat_val[keep], weights[keep])
+            out_valid.write(labels[~is_train], feat_idx[~is_train], feat_val[~is_train])
+        else:
+            out_train.write(labels, feat_idx, feat_val)
+        write_sec += time.time() - start_sec
+    return rows, write_sec
+
+
+def transform_kind(datafile, dataou_dir, kind, n_feat, c_feat, c_feat_offset, split, suffix="",
+                   start=0, end=None, engine="numpy", out_format="text", compression="", sampler=None,
+                   collapse_mb=0, crosser=None, scatter=None):
+    """
+    Transform datafile to {kind}{suffix} outputs, train.txt also writes valid{suffix}.
+    collapse_mb > 0: merge duplicate train rows with buckets of about this size(MB).
+    crosser: append hashed wide crosses to every output.
+    scatter: (tmp_dir, num_buckets, seed), scatter train rows for the external shuffle
+    instead of writing them, gather_buckets() writes the train outputs.
+    """
+    if kind == "train" and scatter is not None:
+        out_train = ScatterSink(scatter[0], suffix, scatter[1], scatter[2])
+    else:
+        out_train = open_sink(dataou_dir + kind + suffix, out_format, compression, crosser)
+    if kind == "train" and collapse_mb > 0:
+        # 编码后每行约为原始数据的3倍大小
+        size = (os.path.getsize(datafile) if end is None else end) - start
+        out_train = CollapseSink(out_train, max(1, -(-3 * size // (collapse_mb << 20))), dataou_dir)
+    out_valid = open_sink(dataou_dir + "valid" + suffix, out_format, compression, crosser) \
+        if kind == "train" else None
+    try:
+        return transform_file(datafile, kind, n_feat, c_feat, c_feat_offset, out_train, out_valid, split,
+                              start, end, engine, sampler)
+    finally:
+        out_train.close()
+        if out_valid is not None:
+            out_valid.close()
+
+
+# 并行转换时每个worker进程持有的特征生成器: (n_feat, c_feat, c_feat_offset, crosser)
+_worker_state = None
+
+
+def _init_transform_worker(n_feat, c_feat, c_feat_offset, crosser=None):
+    global _worker_state
+    _worker_state = (n_feat, c_feat, c_feat_offset, crosser)
+
+
+def _transform_worker(task):
+    datafile, start, end, dataou_dir, kind, shard, num_shards, engine, out_format, compression, split, neg_rate, \
+        collapse_mb, scatter = task
+    n_feat, c_feat, c_feat_offset, crosser = _worker_state
+    sampler = NegativeSampler(neg_rate) if neg_rate < 1 else None
+    # random模式下每个分片使用独立的随机数种子, 划分结果只与分片编号有关
+    return transform_kind(datafile, dataou_dir, kind, n_feat, c_feat, c_feat_offset, make_split(split, seed=shard),
+                          "-%05d-of-%05d" % (shard, num_shards), start, end, engine, out_format, compression,
+                          sampler, collapse_mb, crosser, scatter)
+
+
+def transform_parallel(datafile, dataou_dir, kind, n_feat, c_feat, c_feat_offset, threads=2,
+                       engine="python", out_format="text", compression="", num_shards=0, split="random",
+                       neg_rate=1.0, collapse_mb=0, crosser=None, scatter=None):
+    """
+    Transform datafile by byte-range chunks in worker processes,
+    each chunk is written to its own output shard: {kind}-xxxxx-of-xxxxx.set
+    num_shards: number of chunks, 0 for one chunk per worker.
+    Return (rows, seconds spent in the sinks summed over chunks).
+    """
+    chunks = split_file(datafile, num_shards if num_shards > 0 else threads)
+    tasks = [(datafile, start, end, dataou_dir, kind, shard, len(chunks), engine, out_format, compression, split,
+              neg_rate, collapse_mb, scatter) for shard, (start, end) in enumerate(chunks)]
+    if threads <= 1:
+        # 单进程写分片, 不启动进程池
+        _init_transform_worker(n_feat, c_feat, c_feat_offset, crosser)
+        results = [_transform_worker(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(threads, initializer=_init_transform_worker,
+                                    initargs=(n_feat, c_feat, c_feat_offset, crosser))
+        try:
+            results = pool.map(_transform_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return sum(rows for rows, _ in results), sum(sec for _, sec in results)
+
+
+def shuffle_files(files, mem_mb=256, seed=0, tmp_dir=None):
+    """
+    Two-pass external shuffle of the text lines of files in bounded memory:
+    1) scatter every line into one of N temp buckets uniformly at random,
+       N = total size / mem_mb, so each bucket fits in memory;
+    2) shuffle each bucket in memory and write the buckets back to files in turn.
+       N is rounded up to a multiple of the number of files.
+    Each output file is a uniform random sample of all lines, sizes are kept about equal.
+    """
+    files = sorted(files)
+    total = sum(os.path.getsize(f) for f in files)
+    num_buckets = max(len(files), -(-total // (mem_mb << 20)))
+    num_buckets = -(-num_buckets // len(files)) * len(files)       # 每个输出文件分到相同数量的桶
+    rand = np.random.RandomState(seed)
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    buckets = [open(os.path.join(tmp_dir, "bucket-%05d" % b), 'wb') for b in range(0, num_buckets)]
+    try:
+        # 第一遍: 逐块读取, 每行随机分配到一个临时桶
+        for datafile in files:
+            for data in read_blocks(datafile):
+                lines = np.array(data.rstrip(b'\n').split(b'\n'), dtype=object)
+                bucket = rand.randint(0, num_buckets, size=len(lines))
+                order = np.argsort(bucket, kind='stable')
+                bounds = np.searchsorted(bucket[order], np.arange(0, num_buckets + 1))
+                for b in range(0, num_buckets):
+                    if bounds[b] < bounds[b + 1]:
+                        buckets[b].write(b'\n'.join(lines[order[bounds[b]:bounds[b + 1]]].tolist()) + b'\n')
+        for f in buckets:
+            f.close()
+
+        # 第二遍: 每个桶在内存中打散, 按顺序写回输出文件(覆盖输入文件)
+        outputs = [open(f, 'wb') for f in files]
+        try:
+            for b in range(0, num_buckets):
+                with open(buckets[b].name, 'rb') as f:
+                    lines = f.read().split(b'\n')[:-1]
+                rand.shuffle(lines)
+                if lines:
+                    outputs[b * len(files) // num_buckets].write(b'\n'.join(lines) + b'\n')
+                os.remove(buckets[b].name)
+        finally:
+            for f in outputs:
+                f.close()
+    finally:
+        for f in buckets:
+            f.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return num_buckets
+
+
+def shards_of(datafile):
+    """
+    Number of output shards of datafile, --shard_size_mb is measured on the raw input.
+    """
+    if FLAGS.num_shards > 0:
+        return FLAGS.num_shards
+    if FLAGS.shard_size_mb > 0:
+        return max(1, -(-os.path.getsize(datafile) // (FLAGS.shard_size_mb << 20)))
+    return 0
+
+
+def preprocess_statistics(datain_dir, report):
+    """
+    Build numeric min/max and categorical dictionaries from train.txt.
+    """
+    n_feat = NumericFeatureGenerator(len(numeric_features), FLAGS.clip_quantile, FLAGS.numeric_buckets, FLAGS.kll_k)
+    if FLAGS.clip_quantile > 0 or FLAGS.numeric_buckets > 0:
+        # 分位数sketch按数据块批量更新, 逐值更新每次都要压缩sketch
+        FLAGS.engine = "numpy"
+        FLAGS.stats_pass = "fused"
+    if FLAGS.hash_buckets > 0:
+        # 哈希模式只统计数值特征, 只支持按数据块一次扫描处理
+        c_feat = CategoryHashGenerator(len(categorical_features), FLAGS.hash_buckets)
+        FLAGS.engine = "numpy"
+        FLAGS.stats_pass = "fused"
+    elif FLAGS.sketch_mb > 0:
+        # 近似统计只支持按数据块一次扫描处理, 逐值更新sketch非常慢
+        c_feat = CategorySketchGenerator(len(categorical_features), FLAGS.sketch_mb, threshold=FLAGS.cut_off)
+        FLAGS.engine = "numpy"
+        FLAGS.stats_pass = "fused"
+    else:
+        c_feat = CategoryDictGenerator(len(categorical_features))
+    if FLAGS.counts_in != "":
+        # 由增量处理保存的频次文件重建词表, 不再统计train.txt
+        with report.stage("load_counts"):
+            n_feat, c_feat = load_counts(FLAGS.counts_in.split(','))
+        with report.stage("finalize"):
+            n_feat.finalize()
+            c_feat.finalize(FLAGS.cut_off)
+    elif FLAGS.threads > 1:
+        build_statistics_parallel(datain_dir + "train.txt", n_feat, c_feat,
+                                  cutoff=FLAGS.cut_off, threads=FLAGS.threads, engine=FLAGS.engine, report=report)
+    elif FLAGS.stats_pass == "fused":
+        build_statistics(datain_dir + "train.txt", n_feat, c_feat, cutoff=FLAGS.cut_off, engine=FLAGS.engine,
+                         report=report)
+    else:
+        # 两次扫描, 离散特征的排序包含在第二次扫描中
+        with report.stage("count_numeric", os.path.getsize(datain_dir + "train.txt")) as stage:
+            stage["rows"] = n_feat.build(datain_dir + "train.txt", numeric_features)
+            n_feat.finalize()
+        with report.stage("count_categorical", os.path.getsize(datain_dir + "train.txt")) as stage:
+            stage["rows"] = c_feat.build(datain_dir + "train.txt", categorical_features, cutoff=FLAGS.cut_off)
+    if FLAGS.hash_buckets == 0 and FLAGS.sketch_mb > 0:
+        # 近似统计只保留估计频次达到cutoff的候选值, 不知道真实的不同取值数
+        report.info["dict_candidates_before_cutoff"] = c_feat.distinct_sizes
+        print("dict candidates before cutoff: %s" % report.info["dict_candidates_before_cutoff"])
+    elif FLAGS.hash_buckets == 0:
+        report.info["dict_sizes_before_cutoff"] = c_feat.distinct_sizes
+        print("dict sizes before cutoff: %s" % report.info["dict_sizes_before_cutoff"])
+    if FLAGS.hash_buckets == 0:
+        report.info["dict_sizes_after_cutoff"] = [n - 1 for n in c_feat.dicts_sizes()]
+        print("dict sizes after cutoff:  %s" % report.info["dict_sizes_after_cutoff"])
+    if FLAGS.sketch_mb > 0:
+        print("count-min sketch: %d x %d, error bound %d, values may be misclassified: %s" % (
+            c_feat.sketch.depth, c_feat.sketch.width, c_feat.sketch.error_bound(), c_feat.misclassified))
+        report.info["sketch_error_bound"] = c_feat.sketch.error_bound()
+        if c_feat.sketch.error_bound() >= FLAGS.cut_off:
+            # 误差上界达到cutoff时几乎所有保留的值都可能是误判, 候选值也不再受cutoff约束
+            print("WARNING: sketch error bound %d >= --cut_off %d, increase --sketch_mb or reduce --threads" % (
+                c_feat.sketch.error_bound(), FLAGS.cut_off))
+    if FLAGS.clip_quantile > 0:
+        print("numeric clip at quantile %s: %s" % (FLAGS.clip_quantile, n_feat.clip))
+    if FLAGS.hash_buckets == 0:
+        # 统计完成后转为排序的uint32数组, 按列searchsorted查找
+        with report.stage("compact"):
+            c_feat = c_feat.compact()
+    return n_feat, c_feat
+
+
+def feature_offsets(n_feat, c_feat):
+    """
+    Index offsets of the categorical features, the last one is the max feature index.
+    """
+    dict_sizes = list(c_feat.dicts_sizes())
+    c_feat_offset = [sum(n_feat.dicts_sizes())]
+    for i in range(1, len(categorical_features)+1):
+        c_feat_offset.append(c_feat_offset[i - 1] + dict_sizes[i - 1])
+    return c_feat_offset
+
+
+def write_embed(dataou_dir, n_feat, c_feat):
+    """
+    Write embed.set(feature name -> feature index) and the vocabulary artifact,
+    return the offsets of the categorical features.
+    """
+    # 生成数值特征编号: I1-I13, 分桶模式下为I1|k (k=0为缺失值<unk>)
+    output = open(dataou_dir + "embed.set", 'w')
+    if n_feat.bounds is None:
+        for i in numeric_features:
+            output.write("{0} {1}\n".format('I'+str(i), i))
+    else:
+        for i in range(0, n_feat.num_feature):
+            output.write("{0} {1}\n".format('I'+str(i+1)+'|<unk>', n_feat.offset[i]+1))
+            for k in range(1, n_feat.dicts_sizes()[i]):
+                output.write("{0} {1}\n".format('I'+str(i+1)+'|'+str(k), n_feat.offset[i]+k+1))
+
+    c_feat_offset = feature_offsets(n_feat, c_feat)
+    # 生成离散特征编号: C1|xxxx XX (不同离散特征第一个特征编号的特征统一为<unk>)
+    for i in range(1, len(categorical_features)+1):
+        for key, val in c_feat.items(i-1):
+            output.write("{0} {1}\n".format('C'+str(i)+'|'+key, c_feat_offset[i - 1]+val+1))
+
+    output.close()
+    if FLAGS.vocab_in == "" and FLAGS.hash_buckets == 0:
+        save_vocab(dataou_dir + "vocab", n_feat, c_feat, c_feat_offset, FLAGS.cut_off)
+    return c_feat_offset
+
+
+def make_crosser(n_feat):
+    """
+    Generator of the --crosses wide features, None without crosses.
+    """
+    if FLAGS.crosses == "":
+        return None
+    crosser = CrossFeatureGenerator(FLAGS.crosses, FLAGS.cross_buckets)
+    if crosser.numeric and n_feat.bounds is None:
+        # 归一化后数值特征的编号是常数, 组合前需要分桶
+        raise ValueError("crosses of numeric features need --numeric_buckets")
+    print("wide crosses: %d x %d buckets" % (len(crosser.crosses), crosser.buckets))
+    return crosser
+
+
+def check_flags():
+    """
+    Reject flag combinations that cannot work before anything is read or written.
+    """
+    if FLAGS.stream != "" and FLAGS.vocab_in == "":
+        raise ValueError("--stream needs a saved vocabulary: --vocab_in")
+    if FLAGS.stream != "" and FLAGS.stream_rows <= 0:
+        raise ValueError("--stream_rows must be positive")
+    if FLAGS.out_format == "tfrecord":
+        # TFRecordSink在统计完成、embed.set/vocab覆盖之后才打开, 提前确认TensorFlow可用
+        try:
+            import tensorflow
+        except ImportError:
+            raise ValueError("--out_format tfrecord needs TensorFlow")
+    if FLAGS.counts_in != "":
+        # 频次文件只保存min/max和精确频次, 没有分位数sketch, 也不适用于近似统计/哈希模式
+        for name in ["sketch_mb", "clip_quantile", "numeric_buckets", "hash_buckets"]:
+            if getattr(FLAGS, name) > 0:
+                raise ValueError("--counts_in cannot be combined with --%s" % name)
+    if FLAGS.crosses != "":
+        # 在统计train.txt和覆盖embed.set/vocab之前检查--crosses
+        if FLAGS.cross_buckets <= 0:
+            raise ValueError("--crosses needs --cross_buckets > 0")
+        if CrossFeatureGenerator(FLAGS.crosses, FLAGS.cross_buckets).numeric:
+            if FLAGS.stream != "" or (FLAGS.vocab_in != "" and FLAGS.hash_buckets == 0):
+                with open(FLAGS.vocab_in + ".json", 'r') as f:
+                    bucketed = json.load(f).get("bounds") is not None
+            else:
+                bucketed = FLAGS.numeric_buckets > 0
+            if not bucketed:
+                raise ValueError("crosses of numeric features need --numeric_buckets")
+
 
 def preprocess(datain_dir, dataou_dir):
     """
@@ -110,91 +1858,169 @@ def preprocess(datain_dir, dataou_dir):
     numeric features are combined into one vector with dimension 13.
     Each of the 26 categorical features are one-hot encoded and all the one-hot
     vectors are combined into one sparse binary vector.
+    Stage timings are written to preprocess_report.json next to embed.set.
     """
 
+    report = StageReport()
     print("========== 1.Preprocess numeric and categorical features...")
-    n_feat = NumericFeatureGenerator(len(numeric_features))
-    n_feat.build(datain_dir + "train.txt", numeric_features)
-    c_feat = CategoryDictGenerator(len(categorical_features))
-    c_feat.build(datain_dir + "train.txt", categorical_features, cutoff=FLAGS.cut_off)
+    if FLAGS.vocab_in != "" and FLAGS.hash_buckets == 0:
+        # 复用已保存的词表和归一化参数, 不再统计train.txt
+        with report.stage("load_vocab"):
+            n_feat, c_feat = load_vocab(FLAGS.vocab_in)
+    else:
+        n_feat, c_feat = preprocess_statistics(datain_dir, report)
 
     print("========== 2.Generate index of feature embedding ...")
-    # 生成数值特征编号: I1-I13
-    output = open(dataou_dir + "embed.set", 'w')
-    for i in numeric_features:
-        output.write("{0} {1}\n".format('I'+str(i), i))
+    with report.stage("embed"):
+        c_feat_offset = write_embed(dataou_dir, n_feat, c_feat)
+    # 最大特征编号为c_feat_offset[-1], 训练时读取feature_size, 分桶/哈希模式下无需手工计算
+    report.info["feature_size"] = c_feat_offset[-1] + 1
+    crosser = make_crosser(n_feat)
 
-    dict_sizes = list(c_feat.dicts_sizes())
-    c_feat_offset = [n_feat.num_feature]
-    # 生成离散特征编号: C1|xxxx XX (不同离散特征第一个特征编号的特征统一为<unk>)
-    for i in range(1, len(categorical_features)+1):
-        offset = c_feat_offset[i - 1] + dict_sizes[i - 1]
-        c_feat_offset.append(offset)
-        for key, val in c_feat.dicts[i-1].items():
-            output.write("{0} {1}\n".format('C'+str(i)+'|'+key, c_feat_offset[i - 1]+val+1))
-
-    random.seed(0)
     # 90% data are used for training, and 10% data are used for validation
-    print("========== 3.Generate train/valid/test dataset ...")
-    with open(dataou_dir + "train.set", 'w') as out_train:
-        with open(dataou_dir + "valid.set", 'w') as out_valid:
-            with open(datain_dir + "train.txt", 'r') as f:
-                for line in f:
-                    features = line.rstrip('\n').split('\t')
-
-                    feat_val = []
-                    # numeric features normalized to [0,1]
-                    for i in range(0, len(numeric_features)):
-                        val = n_feat.gen(i, features[numeric_features[i]])
-                        feat_val.append(str(numeric_features[i]) + ':' + "{0:.6f}".format(val).rstrip('0').rstrip('.'))
-
-                    # categorical features one-hot embedding
-                    for i in range(0, len(categorical_features)):
-                        val = c_feat.gen(i, features[categorical_features[i]]) + c_feat_offset[i] + 1
-                        feat_val.append(str(val) + ':1')
-
-                    label = features[0]
-                    if random.randint(0, 9999) % 10 != 0:
-                        out_train.write("{0} {1}\n".format(label, ' '.join(feat_val)))
-                    else:
-                        out_valid.write("{0} {1}\n".format(label, ' '.join(feat_val)))
-
-    with open(dataou_dir + "tests.set", 'w') as out_test:
-        with open(datain_dir + "train_test.txt", 'r') as f:
-            for line in f:
-                features = line.rstrip('\n').split('\t')
+    # 训练集负样本按neg_rate降采样, 验证/测试集保持原始分布
+    sampler = NegativeSampler(FLAGS.neg_rate) if FLAGS.neg_rate < 1 else None
+    datasets = [("train", "train.txt"), ("tests", "train_test.txt"), ("infer", "test.txt")]
+    sharded = FLAGS.threads > 1 or FLAGS.num_shards > 0 or FLAGS.shard_size_mb > 0
+    scatter, suffixes = None, [""]
+    if FLAGS.shuffle_mem_mb > 0 and sharded:
+        # 本次运行写出的训练集分片, 与transform_parallel的分片编号一致
+        num_chunks = len(split_file(datain_dir + "train.txt", shards_of(datain_dir + "train.txt") or FLAGS.threads))
+        suffixes = ["-%05d-of-%05d" % (shard, num_chunks) for shard in range(0, num_chunks)]
+    if FLAGS.shuffle_mem_mb > 0 and FLAGS.out_format != "text":
+        # 二进制输出无法按行打散, 转换时先把编码后的训练样本随机分配到临时桶(外部打散的第一遍)
+        # 编码后每行约为原始数据的3倍大小, 桶数取输出文件数的整数倍
+        num_buckets = max(1, -(-3 * os.path.getsize(datain_dir + "train.txt") // (FLAGS.shuffle_mem_mb << 20)))
+        num_buckets = -(-num_buckets // len(suffixes)) * len(suffixes)
+        scatter = (tempfile.mkdtemp(dir=dataou_dir), num_buckets, FLAGS.shuffle_seed)
+    for kind, filename in datasets:
+        if kind == "infer":
+            print("========== 4.Generate infer dataset ...")
+        elif kind == "train":
+            print("========== 3.Generate train/valid/test dataset ...")
+        with report.stage("transform_" + kind, os.path.getsize(datain_dir + filename)) as stage:
+            if sharded:
+                # 分片模式: 每个分片独立输出, random划分结果与单文件模式不同
+                rows, write_sec = transform_parallel(datain_dir + filename, dataou_dir, kind,
+                                                     n_feat, c_feat, c_feat_offset, FLAGS.threads, FLAGS.engine,
+                                                     FLAGS.out_format, FLAGS.compression,
+                                                     shards_of(datain_dir + filename), FLAGS.split,
+                                                     FLAGS.neg_rate, FLAGS.collapse_mb, crosser, scatter)
+            else:
+                rows, write_sec = transform_kind(datain_dir + filename, dataou_dir, kind, n_feat, c_feat,
+                                                 c_feat_offset, make_split(FLAGS.split), engine=FLAGS.engine,
+                                                 out_format=FLAGS.out_format, compression=FLAGS.compression,
+                                                 sampler=sampler, collapse_mb=FLAGS.collapse_mb,
+                                                 crosser=crosser, scatter=scatter)
+            stage["rows"] = rows
+            # 输出格式化和写文件的耗时(并行模式下为各进程耗时之和)
+            stage["write_seconds"] = round(write_sec, 3)
 
-                feat_val = []
-                # numeric features normalized to [0,1]
-                for i in range(0, len(numeric_features)):
-                    val = n_feat.gen(i, features[numeric_features[i]])
-                    feat_val.append(str(numeric_features[i]) + ':' + "{0:.6f}".format(val).rstrip('0').rstrip('.'))
+    if scatter is not None:
+        # 外部打散的第二遍: 每个桶在内存中打散后依次写入训练集输出
+        print("========== 5.Shuffle train dataset ...")
+        tmp_dir, num_buckets, _ = scatter
+        with report.stage("shuffle", sum(os.path.getsize(os.path.join(tmp_dir, f))
+                                         for f in os.listdir(tmp_dir))) as stage:
+            try:
+                prefixes = [dataou_dir + "train" + suffix for suffix in suffixes]
+                stage["rows"] = gather_buckets(tmp_dir, num_buckets, prefixes, FLAGS.out_format, FLAGS.compression,
+                                               crosser, FLAGS.shuffle_seed)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        print("external shuffle: %d buckets" % num_buckets)
+    elif FLAGS.shuffle_mem_mb > 0:
+        # 原始数据按时间排序, 训练集需要全局打散
+        print("========== 5.Shuffle train dataset ...")
+        # 只打散本次运行写出的文件, 不包括输出目录中以前的train.set或--stream分片
+        files = [dataou_dir + "train" + suffix + ".set" for suffix in suffixes]
+        with report.stage("shuffle", sum(os.path.getsize(f) for f in files)):
+            num_buckets = shuffle_files(files, FLAGS.shuffle_mem_mb, FLAGS.shuffle_seed, dataou_dir)
+        print("external shuffle: %d buckets" % num_buckets)
 
-                # categorical features one-hot embedding
-                for i in range(0, len(categorical_features)):
-                    val = c_feat.gen(i, features[categorical_features[i]]) + c_feat_offset[i] + 1
-                    feat_val.append(str(val) + ':1')
+    report.info["flags"] = vars(FLAGS)
+    report.save(dataou_dir + "preprocess_report.json")
 
-                label = features[0]
-                out_test.write("{0} {1}\n".format(label, ' '.join(feat_val)))
 
-    print("========== 4.Generate infer dataset ...")
-    with open(dataou_dir + "infer.set", 'w') as out_infer:
-        with open(datain_dir + "test.txt", 'r') as f:
-            for line in f:
-                features = line.rstrip('\n').split('\t')
+def preprocess_stream(stream, dataou_dir):
+    """
+    Incremental mode: transform labelled raw rows from stdin('-') or a growing
+    file with a saved vocabulary, and publish rolling output shards
+    {prefix}-{start time}-xxxxx.set once every --stream_rows rows or
+    --stream_secs seconds. Shards are written to a temp dir first, so readers
+    never see partial files. Optionally save the raw counts of the rows for
+    the next vocabulary refresh(--counts_in).
+    """
+    report = StageReport()
+    n_feat, c_feat = load_vocab(FLAGS.vocab_in)
+    c_feat_offset = feature_offsets(n_feat, c_feat)
+    report.info["feature_size"] = c_feat_offset[-1] + 1
+    crosser = make_crosser(n_feat)
+    if FLAGS.stream_counts:
+        n_cnt = NumericFeatureGenerator(len(numeric_features))
+        c_cnt = CategoryDictGenerator(len(categorical_features))
+    tmp_dir = dataou_dir + "_stream_tmp" + os.sep
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    stamp = time.strftime("%Y%m%d%H%M%S")
 
-                feat_val = []
-                for i in range(0, len(numeric_features)):
-                    val = n_feat.gen(i, features[numeric_features[i] - 1])
-                    feat_val.append(str(numeric_features[i]) + ':' + "{0:.6f}".format(val).rstrip('0').rstrip('.'))
+    def publish(name, sink):
+        sink.close()
+        for filename in os.listdir(tmp_dir):
+            if filename.startswith(name + "."):
+                os.replace(tmp_dir + filename, dataou_dir + filename)
+        print("published shard %s" % name)
 
-                for i in range(0, len(categorical_features)):
-                    val = c_feat.gen(i, features[categorical_features[i] - 1]) + c_feat_offset[i] + 1
-                    feat_val.append(str(val) + ':1')
+    sampler = NegativeSampler(FLAGS.neg_rate) if FLAGS.neg_rate < 1 else None
+    sink, name, num_shards = None, "", 0
+    num_cols = 1 + len(numeric_features) + len(categorical_features)
+    with report.stage("stream") as stage:
+        try:
+            for data in follow_blocks(stream, poll_sec=FLAGS.stream_poll, idle_sec=FLAGS.stream_idle,
+                                      num_cols=num_cols):
+                if not data:
+                    # 等待新数据时也检查--stream_secs, 安静期间已写入的行按时发布
+                    if sink is not None and 0 < FLAGS.stream_secs <= time.time() - shard_start:
+                        publish(name, sink)
+                        sink, num_shards = None, num_shards + 1
+                    continue
+                block, labels, feat_idx, feat_val = encode_data(data, "train", n_feat, c_feat, c_feat_offset)
+                if sampler is not None:
+                    keep, weights = sampler.sample(block, labels)
+                if FLAGS.stream_counts:
+                    collect_statistics_block(block, n_cnt, c_cnt)
+                stage["rows"] += block.num_rows
+                stage["bytes"] += len(data)
+                # 按分片剩余的行数切分数据块, 每个分片最多--stream_rows行
+                pos = 0
+                while pos < block.num_rows:
+                    if sink is None:
+                        name = "%s-%s-%05d" % (FLAGS.stream_prefix, stamp, num_shards)
+                        sink = open_sink(tmp_dir + name, FLAGS.out_format, FLAGS.compression, crosser)
+                        shard_rows, shard_start = 0, time.time()
+                    end = min(block.num_rows, pos + FLAGS.stream_rows - shard_rows)
+                    if sampler is None:
+                        sink.write(labels[pos:end], feat_idx[pos:end], feat_val[pos:end])
+                    else:
+                        kept = np.flatnonzero(keep[pos:end]) + pos
+                        sink.write(labels[kept], feat_idx[kept], feat_val[kept], weights[kept])
+                    shard_rows += end - pos
+                    pos = end
+                    if shard_rows >= FLAGS.stream_rows or 0 < FLAGS.stream_secs <= time.time() - shard_start:
+                        publish(name, sink)
+                        sink, num_shards = None, num_shards + 1
+        finally:
+            # 出错退出时也发布已写入的分片, 并清理临时目录
+            if sink is not None:
+                publish(name, sink)
+                num_shards += 1
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-                label = 0       # test fake label
-                out_infer.write("{0} {1}\n".format(label, ' '.join(feat_val)))
+    report.info["shards"] = num_shards
+    if FLAGS.stream_counts:
+        save_counts(dataou_dir + "%s-%s.counts.npz" % (FLAGS.stream_prefix, stamp), n_cnt, c_cnt)
+    report.info["flags"] = vars(FLAGS)
+    report.save(dataou_dir + "stream_report.json")
 
 
 if __name__ == "__main__":
@@ -207,15 +2033,105 @@ if __name__ == "__main__":
         dir_dataou = ""
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--threads", type=int, default=2, help="threads num")
+    parser.add_argument("--threads", type=int, default=1, help="worker processes num, >1 writes sharded outputs")
     parser.add_argument("--data_in", type=str, default=dir_datain, help="data_in dir")
     parser.add_argument("--data_ou", type=str, default=dir_dataou, help="data_out dir")
     parser.add_argument("--cut_off", type=int, default=200, help="cutoff long-tailed categorical values")
+    parser.add_argument("--stats_pass", type=str, default="fused", choices=["fused", "multi"],
+                        help="fused: one scan for numeric/categorical statistics; multi: one scan each, "
+                             "--hash_buckets/--sketch_mb/--clip_quantile/--numeric_buckets always use fused")
+    parser.add_argument("--engine", type=str, default="numpy", choices=["numpy", "python"],
+                        help="numpy: column-wise block processing; python: line-by-line loops")
+    parser.add_argument("--sketch_mb", type=int, default=0,
+                        help="memory budget(MB) of the count-min tables of approximate categorical counting, "
+                             "split across the --threads shards and the merging parent, 0: exact counting. "
+                             "Candidate values above cut_off/threads per shard are kept outside the budget")
+    parser.add_argument("--out_format", type=str, default="text", choices=["text", "npy", "tfrecord"],
+                        help="text: 'label idx:val' lines; npy: int32 idx/float32 val/label matrices; "
+                             "tfrecord: tf.train.Example with int64 feat_idx/float32 feat_val")
+    parser.add_argument("--compression", type=str, default="", choices=["", "GZIP", "ZLIB"],
+                        help="compression of tfrecord output")
+    parser.add_argument("--vocab_in", type=str, default="",
+                        help="prefix of a saved vocabulary artifact(e.g. data_set_criteo/vocab), skip statistics")
+    parser.add_argument("--hash_buckets", type=int, default=0,
+                        help="hash categorical values into buckets per field without vocabulary, 0: vocabulary")
+    parser.add_argument("--clip_quantile", type=float, default=0.0,
+                        help="clip numeric features at this quantile of the data(e.g. 0.95), 0: numeric_clip")
+    parser.add_argument("--numeric_buckets", type=int, default=0,
+                        help="bucketize numeric features into quantile buckets as categorical ids, 0: min-max")
+    parser.add_argument("--kll_k", type=int, default=200, help="size parameter of the KLL quantile sketch")
+    parser.add_argument("--num_shards", type=int, default=0,
+                        help="write {train,valid,tests,infer}-xxxxx-of-xxxxx shards, 0: one file per dataset")
+    parser.add_argument("--shard_size_mb", type=int, default=0,
+                        help="shard by raw input size(MB) instead of a fixed --num_shards")
+    parser.add_argument("--split", type=str, default="random", choices=["random", "hash"],
+                        help="train/valid split, random: seeded random draw per row; hash: crc32 of the raw line")
+    parser.add_argument("--shuffle_mem_mb", type=int, default=0,
+                        help="external shuffle of the train outputs with buckets of this size(MB): text lines of "
+                             "train*.set, encoded rows for npy/tfrecord, 0: no shuffle")
+    parser.add_argument("--shuffle_seed", type=int, default=0, help="random seed of the external shuffle")
+    parser.add_argument("--neg_rate", type=float, default=1.0,
+                        help="keep this fraction of negative train rows with weight 1/neg_rate, the weighted "
+                             "loss keeps predictions calibrated without correction, 1: no downsampling")
+    parser.add_argument("--collapse_mb", type=int, default=0,
+                        help="merge duplicate encoded train rows into weighted examples with buckets of this "
+                             "size(MB), 0: no merging")
+    parser.add_argument("--crosses", type=str, default="",
+                        help="comma separated hashed wide crosses of fields, e.g. C1xC2,C1xC2xC3, '': no crosses. "
+                             "Crosses are hashed from the encoded ids, values below --cut_off are <unk> in every "
+                             "cross, use --hash_buckets to keep long-tail values")
+    parser.add_argument("--cross_buckets", type=int, default=100000, help="hash buckets per wide cross")
+    parser.add_argument("--counts_in", type=str, default="",
+                        help="comma separated .counts.npz files of --stream_counts, rebuild vocabulary from them")
+    parser.add_argument("--stream", type=str, default="",
+                        help="incremental mode: read labelled raw rows from stdin('-') or a growing file, "
+                             "transform them with --vocab_in into rolling shards")
+    parser.add_argument("--stream_prefix", type=str, default="train", help="name prefix of the rolling shards")
+    parser.add_argument("--stream_rows", type=int, default=1000000,
+                        help="max input rows per rolling shard(before --neg_rate)")
+    parser.add_argument("--stream_secs", type=float, default=0,
+                        help="max seconds per rolling shard, also checked while waiting for data, 0: no limit")
+    parser.add_argument("--stream_poll", type=float, default=1.0, help="poll interval(s) of a growing file")
+    parser.add_argument("--stream_idle", type=float, default=0,
+                        help="stop after no new data for this many seconds, 0: stop at end of file, <0: never")
+    parser.add_argument("--stream_counts", type=int, default=0, choices=[0, 1],
+                        help="1: save raw counts of the streamed rows for the next vocabulary refresh")
     FLAGS, unparsed = parser.parse_known_args()
     print("threads -------------- ", FLAGS.threads)
     print("input_dir ------------ ", FLAGS.data_in)
     print("output_dir ----------- ", FLAGS.data_ou)
     print("cutoff --------------- ", FLAGS.cut_off)
+    print("stats_pass ----------- ", FLAGS.stats_pass)
+    print("engine --------------- ", FLAGS.engine)
+    print("sketch_mb ------------ ", FLAGS.sketch_mb)
+    print("out_format ----------- ", FLAGS.out_format)
+    print("compression ---------- ", FLAGS.compression)
+    print("vocab_in ------------- ", FLAGS.vocab_in)
+    print("hash_buckets --------- ", FLAGS.hash_buckets)
+    print("clip_quantile -------- ", FLAGS.clip_quantile)
+    print("numeric_buckets ------ ", FLAGS.numeric_buckets)
+    print("kll_k ---------------- ", FLAGS.kll_k)
+    print("num_shards ----------- ", FLAGS.num_shards)
+    print("shard_size_mb -------- ", FLAGS.shard_size_mb)
+    print("split ---------------- ", FLAGS.split)
+    print("shuffle_mem_mb ------- ", FLAGS.shuffle_mem_mb)
+    print("shuffle_seed --------- ", FLAGS.shuffle_seed)
+    print("neg_rate ------------- ", FLAGS.neg_rate)
+    print("collapse_mb ---------- ", FLAGS.collapse_mb)
+    print("crosses -------------- ", FLAGS.crosses)
+    print("cross_buckets -------- ", FLAGS.cross_buckets)
+    print("counts_in ------------ ", FLAGS.counts_in)
+    print("stream --------------- ", FLAGS.stream)
+    print("stream_prefix -------- ", FLAGS.stream_prefix)
+    print("stream_rows ---------- ", FLAGS.stream_rows)
+    print("stream_secs ---------- ", FLAGS.stream_secs)
+    print("stream_poll ---------- ", FLAGS.stream_poll)
+    print("stream_idle ---------- ", FLAGS.stream_idle)
+    print("stream_counts -------- ", FLAGS.stream_counts)
 
     # 特征预处理
-    preprocess(FLAGS.data_in, FLAGS.data_ou)
+    check_flags()
+    if FLAGS.stream != "":
+        preprocess_stream(FLAGS.stream, FLAGS.data_ou)
+    else:
+        preprocess(FLAGS.data_in, FLAGS.data_ou)
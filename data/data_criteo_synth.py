@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Generate synthetic Criteo-shaped data for preprocessing/training benchmarks.
+----输出格式与原始数据完全一致: label \t I1-I13 \t C1-C26, 缺失值为空字段;
+----train.txt/train_test.txt有label, test.txt没有label;
+----数值特征为对数正态分布的计数, 离散特征为8位16进制哈希值, 出现频次服从Zipf分布;
+----相同的seed/行数生成完全相同的文件.
+############### TF Version: 1.13.1/Python Version: 3.7 ###############
+"""
+
+import os
+import argparse
+import numpy as np
+
+# 每个数值特征的缺失比例和对数正态分布参数(参考原始数据的统计)
+numeric_missing = [0.45, 0.0, 0.21, 0.22, 0.03, 0.22, 0.04, 0.0, 0.04, 0.45, 0.04, 0.77, 0.22]
+numeric_lognorm = [(0.5, 1.2), (1.5, 2.0), (1.5, 1.5), (1.5, 1.0), (7.5, 2.0), (3.5, 1.8), (1.5, 1.5),
+                   (2.5, 1.0), (3.5, 1.5), (0.2, 0.6), (1.0, 1.0), (0.2, 1.0), (1.5, 1.2)]
+# 每个离散特征的取值个数和缺失比例(参考原始数据的统计)
+categorical_cardinality = [1460, 583, 10131227, 2202608, 305, 24, 12517, 633, 3, 93145, 5683, 8351593, 3194,
+                           27, 14992, 5461306, 10, 5652, 2173, 4, 7046547, 18, 15, 286181, 105, 142572]
+categorical_missing = [0.0, 0.0, 0.03, 0.03, 0.0, 0.12, 0.0, 0.0, 0.0, 0.0, 0.0, 0.03, 0.0,
+                       0.0, 0.0, 0.03, 0.0, 0.0, 0.44, 0.44, 0.03, 0.76, 0.0, 0.03, 0.44, 0.44]
+
+# 每次生成的行数, 与seed一起决定随机数序列, 修改后生成的数据会不同
+CHUNK_ROWS = 100000
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def hash_values(field, ids):
+    """
+    Map value ranks of a field to distinct uint32 hashes, (ids+1)*odd is a bijection mod 2^32.
+    """
+    ids = ids.astype(np.uint64) + np.uint64(1)
+    return ((ids * np.uint64(2654435761)) ^ np.uint64((field * 0x9e3779b9) & 0xffffffff)) & np.uint64(0xffffffff)
+
+
+def hex_column(values, missing):
+    # uint32 -> 8位16进制字符串(bytes), 缺失值为空
+    shifts = np.arange(28, -1, -4, dtype=np.uint64)
+    chars = HEX_DIGITS[((values[:, None] >> shifts) & np.uint64(15)).astype(np.int64)]
+    col = np.ascontiguousarray(chars).view('S8').ravel()
+    col[missing] = b''
+    return col
+
+
+def gen_chunk(rand, rows, with_label=True, zipf_a=1.2, ctr=0.25):
+    """
+    Generate rows of Criteo TSV lines(bytes, without line breaks).
+    The click probability depends on C1-C3 so that models have something to learn.
+    """
+    cols = []
+    for i in range(0, len(numeric_missing)):
+        mean, sigma = numeric_lognorm[i]
+        val = np.floor(rand.lognormal(mean, sigma, rows)).astype(np.int64)
+        if i == 1:
+            # I2存在少量负值
+            neg = rand.random_sample(rows) < 0.05
+            val[neg] = -rand.randint(1, 4, size=int(np.count_nonzero(neg)))
+        col = val.astype('S20')
+        col[rand.random_sample(rows) < numeric_missing[i]] = b''
+        cols.append(col)
+
+    logit = np.full(rows, np.log(ctr / (1 - ctr)))
+    for j in range(0, len(categorical_cardinality)):
+        # Zipf分布的取值排名, 超过取值个数的排名折回
+        ids = (rand.zipf(zipf_a, rows) - 1) % categorical_cardinality[j]
+        values = hash_values(j, ids)
+        missing = rand.random_sample(rows) < categorical_missing[j]
+        if j < 3:
+            weight = ((values >> np.uint64(8)) & np.uint64(255)).astype(np.float64) / 255 - 0.5
+            logit += np.where(missing, 0.0, 2.0 * weight)
+        cols.append(hex_column(values, missing))
+
+    if with_label:
+        label = rand.random_sample(rows) < 1 / (1 + np.exp(-logit))
+        cols.insert(0, np.where(label, b'1', b'0'))
+    return [b'\t'.join(row) for row in zip(*[col.tolist() for col in cols])]
+
+
+def write_file(path, num_rows, seed, with_label=True, zipf_a=1.2, ctr=0.25):
+    rand = np.random.RandomState(seed)
+    with open(path, 'wb') as f:
+        for start in range(0, num_rows, CHUNK_ROWS):
+            lines = gen_chunk(rand, min(CHUNK_ROWS, num_rows - start), with_label, zipf_a, ctr)
+            f.write(b'\n'.join(lines) + b'\n')
+    print("%s: %d rows, %.1f MB" % (path, num_rows, os.path.getsize(path) / float(1 << 20)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_ou", type=str, default=os.path.join(os.getcwd(), "data_raw_criteo", ""),
+                        help="output dir of train.txt/train_test.txt/test.txt")
+    parser.add_argument("--train_rows", type=int, default=1000000, help="rows of train.txt")
+    parser.add_argument("--tests_rows", type=int, default=-1, help="rows of train_test.txt, -1: train_rows/10")
+    parser.add_argument("--infer_rows", type=int, default=-1, help="rows of test.txt, -1: train_rows/10")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, same seed generates same files")
+    parser.add_argument("--zipf_a", type=float, default=1.2, help="Zipf exponent of categorical frequencies")
+    parser.add_argument("--ctr", type=float, default=0.25, help="base click-through rate")
+    FLAGS, unparsed = parser.parse_known_args()
+    print("output_dir ----------- ", FLAGS.data_ou)
+    print("train_rows ----------- ", FLAGS.train_rows)
+    print("tests_rows ----------- ", FLAGS.tests_rows)
+    print("infer_rows ----------- ", FLAGS.infer_rows)
+    print("seed ----------------- ", FLAGS.seed)
+    print("zipf_a --------------- ", FLAGS.zipf_a)
+    print("ctr ------------------ ", FLAGS.ctr)
+
+    tests_rows = FLAGS.train_rows // 10 if FLAGS.tests_rows < 0 else FLAGS.tests_rows
+    infer_rows = FLAGS.train_rows // 10 if FLAGS.infer_rows < 0 else FLAGS.infer_rows
+    # 每个文件使用不同的seed, 改变一个文件的行数不影响其它文件
+    write_file(os.path.join(FLAGS.data_ou, "train.txt"), FLAGS.train_rows, FLAGS.seed, True,
+               FLAGS.zipf_a, FLAGS.ctr)
+    write_file(os.path.join(FLAGS.data_ou, "train_test.txt"), tests_rows, FLAGS.seed + 1, True,
+               FLAGS.zipf_a, FLAGS.ctr)
+    write_file(os.path.join(FLAGS.data_ou, "test.txt"), infer_rows, FLAGS.seed + 2, False,
+               FLAGS.zipf_a, FLAGS.ctr)
@@ -5,6 +5,21 @@ import tensorflow as tf
 from tensorflow_estimator import estimator
 
 
+def sample_weight(features, labels):
+    # 负采样后的样本权重(负样本为1/保留比例)或合并重复样本后的曝光数, 输入没有权重列时为1
+    # 加权后的loss是全量数据loss的无偏估计, 预测值不需要再做负采样校正
+    if labels is None:          # predict模式没有label, 也不需要权重
+        return None
+    if "weight" in features:
+        return tf.reshape(features["weight"], shape=[-1])
+    return tf.ones_like(labels)
+
+
+def weighted_mean(losses, weights):
+    # 按样本权重加权平均, 权重全为1时等价于tf.reduce_mean
+    return tf.reduce_sum(tf.multiply(losses, weights)) / tf.reduce_sum(weights)
+
+
 # LR: Predicting Clicks - Estimating the Click-Through Rate for New Ads.
 def lr(features, labels, mode, params):
 
@@ -26,6 +41,7 @@ def lr(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------------ define f(x) ----------------- #
     # LR: y = b + sum<wi,xi>
@@ -51,11 +67,11 @@ def lr(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -102,6 +118,7 @@ def fm(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     # FM: y = b + sum<wi,xi> + sum(<vi,vj>xi*xj)
@@ -135,11 +152,11 @@ def fm(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w) + l2_reg_lambda * tf.nn.l2_loss(coe_v)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -185,6 +202,7 @@ def deepcrossing(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("Embed-Layer"):
@@ -226,11 +244,11 @@ def deepcrossing(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_v)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -286,6 +304,7 @@ def fpnn(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("Linear-Part"):
@@ -375,11 +394,11 @@ def fpnn(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w) + l2_reg_lambda * tf.nn.l2_loss(coe_v)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -414,6 +433,8 @@ def wd(features, labels, mode, params):
     l2_reg_lambda = params["l2_reg_lambda"]
     layers = list(map(int, params["deep_layers"].split(',')))
     dropout = list(map(float, params["dropout"].split(',')))
+    cross_num = params.get("cross_num", 0)
+    cross_buckets = params.get("cross_buckets", 0)
 
     # ---------- initial weights ----------- #
     # [numeric_feature, one-hot categorical_feature]统一做embedding
@@ -421,18 +442,28 @@ def wd(features, labels, mode, params):
     coe_w = tf.get_variable(name="coe_w", shape=[feature_size], initializer=tf.glorot_normal_initializer())
     coe_v = tf.get_variable(name="coe_v", shape=[feature_size, embed_size],
                             initializer=tf.glorot_normal_initializer())
+    if cross_num > 0:
+        # 哈希组合特征的权重, 大小只与哈希桶数有关
+        coe_c = tf.get_variable(name="coe_c", shape=[cross_num * cross_buckets],
+                                initializer=tf.zeros_initializer())
 
     # ---------- reshape feature ----------- #
     feat_idx = features["feat_idx"]         # 非零特征位置[batch_size, field_size, 1]
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("Wide-Layer"):
         # 论文里面包含人工组合的特征
         feat_wgt = tf.nn.embedding_lookup(coe_w, feat_idx)              # [Batch, Field]
         y_wide = tf.reduce_sum(tf.multiply(feat_wgt, feat_val), 1)      # [Batch]
+        if cross_num > 0:
+            # 组合特征取值为1, 稀疏查找只更新本batch出现的哈希桶
+            wide_idx = tf.reshape(features["wide_idx"], shape=[-1, cross_num])     # [Batch, Cross]
+            cross_wgt = tf.nn.embedding_lookup(coe_c, wide_idx)                     # [Batch, Cross]
+            y_wide += tf.reduce_sum(cross_wgt, 1)                                   # [Batch]
 
     with tf.variable_scope("Embed-Layer"):
         embeddings = tf.nn.embedding_lookup(coe_v, feat_idx)            # [Batch, Field, K]
@@ -473,11 +504,14 @@ def wd(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w) + l2_reg_lambda * tf.nn.l2_loss(coe_v)
+        if cross_num > 0:
+            # 只对本batch查找到的组合特征权重做正则, 保持梯度稀疏
+            loss += l2_reg_lambda * tf.nn.l2_loss(cross_wgt)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -525,6 +559,7 @@ def deepfm(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("First-Order"):
@@ -573,11 +608,11 @@ def deepfm(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w) + l2_reg_lambda * tf.nn.l2_loss(coe_v)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -629,6 +664,7 @@ def dcn(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("Embed-Layer"):
@@ -677,13 +713,13 @@ def dcn(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) \
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) \
                + l2_reg_lambda * tf.nn.l2_loss(coe_v) + l2_reg_lambda * tf.nn.l2_loss(cross_b) \
                + l2_reg_lambda * tf.nn.l2_loss(cross_w)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred)) + l2_reg_lambda * tf.nn.l2_loss(coe_v) \
+        loss = weighted_mean(tf.square(labels-y_pred), weights) + l2_reg_lambda * tf.nn.l2_loss(coe_v) \
                + l2_reg_lambda * tf.nn.l2_loss(cross_b) + l2_reg_lambda * tf.nn.l2_loss(cross_w)
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -731,6 +767,7 @@ def nfm(features, labels, mode, params):
     feat_idx = tf.reshape(feat_idx, shape=[-1, field_size])     # [Batch, Field]
     feat_val = features["feat_val"]         # 非零特征的值[batch_size, field_size, 1]
     feat_val = tf.reshape(feat_val, shape=[-1, field_size])     # [Batch, Field]
+    weights = sample_weight(features, labels)                   # 负采样样本权重[Batch]
 
     # ------------- define f(x) ------------ #
     with tf.variable_scope("First-Order"):
@@ -779,11 +816,11 @@ def nfm(features, labels, mode, params):
 
     # Provide an estimator spec for 'ModeKeys.EVAL'
     if loss_mode == "log_loss":
-        loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat)) +\
+        loss = weighted_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=y_hat), weights) +\
                l2_reg_lambda * tf.nn.l2_loss(coe_w) + l2_reg_lambda * tf.nn.l2_loss(coe_v)
     else:
-        loss = tf.reduce_mean(tf.square(labels-y_pred))
-    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred)}
+        loss = weighted_mean(tf.square(labels-y_pred), weights)
+    eval_metric_ops = {"auc": tf.metrics.auc(labels, y_pred, weights=weights)}
     if mode == estimator.ModeKeys.EVAL:
         return estimator.EstimatorSpec(mode=mode, predictions=predictions, loss=loss,
                                        eval_metric_ops=eval_metric_ops)
@@ -13,8 +13,11 @@ Implementation of CTR model with the following features:
 import os
 import json
 import glob
+import hashlib
 import random
 import shutil
+import time
+import numpy as np
 import tensorflow as tf
 from datetime import date, timedelta
 from tensorflow_estimator import estimator
@@ -32,16 +35,33 @@ flags.DEFINE_integer("task_id", None, "Index of task within the job")
 flags.DEFINE_integer("num_thread", 4, "Number of threads")
 # global parameters--全局参数设置
 flags.DEFINE_string("algorithm", "NFM", "{LR,FM,DC,FNN,IPNN,OPNN,WD,DeepFM,DCN,NFM}")
-flags.DEFINE_string("task_mode", "train", "{train, eval, infer, export}")
+flags.DEFINE_string("task_mode", "train", "{train, eval, infer, export, bench_input}")
 flags.DEFINE_string("input_dir", "", "Input data dir")
+flags.DEFINE_string("input_format", "text", "{text, npy, tfrecord}, format of preprocessed data[--out_format]")
+flags.DEFINE_string("parse_mode", "line", "{line, batch}, parse text data per line or per batch of lines")
+flags.DEFINE_integer("cycle_length", 0, "Number of files read in parallel by interleave, 0: read files in turn")
+flags.DEFINE_integer("block_length", 16, "Consecutive records taken from each file by interleave")
+flags.DEFINE_string("cache_mode", "none", "{none, memory, file}, cache parsed train/valid data across epochs")
+flags.DEFINE_string("cache_dir", "", "Dir of cache files of --cache_mode=file, default input_dir/cache")
+flags.DEFINE_integer("parallel_calls", 0, "Parallel calls of the parse map, 0: num_thread, -1: AUTOTUNE")
+flags.DEFINE_integer("prefetch_batches", 100, "Batches prefetched after batching, -1: AUTOTUNE")
+flags.DEFINE_integer("shuffle_buffer", 256, "Shuffle buffer size(examples) of the train data")
+flags.DEFINE_integer("reshuffle", 1, "Whether to reshuffle the train data every epoch {0,1}")
+flags.DEFINE_string("compression", "", "{'', GZIP, ZLIB}, compression of tfrecord data")
 flags.DEFINE_string("model_dir", "", "Model check point file dir")
 flags.DEFINE_string("serve_dir", "", "Export servable model for TensorFlow Serving")
 flags.DEFINE_string("clear_mod", "True", "{True, False},Clear existed model or not")
 flags.DEFINE_integer("log_steps", 2000, "Save summary every steps")
+flags.DEFINE_integer("bench_steps", 1000, "Batches read per stage by task_mode=bench_input, 0: one epoch")
 # model parameters--模型参数设置
 flags.DEFINE_integer("samples_size", 269738, "Number of train samples")
-flags.DEFINE_integer("feature_size", 2829, "Number of features[numeric + one-hot categorical_feature]")
+flags.DEFINE_integer("feature_size", 2830, "Number of features[numeric + one-hot categorical_feature], "
+                                          "read from the preprocess/stream report of input_dir if not given")
 flags.DEFINE_integer("field_size", 39, "Number of fields")
+flags.DEFINE_integer("hash_buckets", 0, "Hash buckets per categorical field[--hash_buckets], >0 derives feature_size "
+                                          "if input_dir has no preprocess/stream report(without --numeric_buckets only)")
+flags.DEFINE_string("crosses", "", "Hashed wide crosses of the data[--crosses], e.g. C1xC2,C1xC2xC3, used by WD")
+flags.DEFINE_integer("cross_buckets", 100000, "Hash buckets per wide cross[--cross_buckets]")
 flags.DEFINE_integer("embed_size", 16, "Embedding size[length of hidden vector of xi/xj]")
 flags.DEFINE_integer("num_epochs", 10, "Number of epochs")
 flags.DEFINE_integer("batch_size", 256, "Number of batch size")
@@ -57,40 +77,321 @@ flags.DEFINE_float("batch_norm_decay", 0.9, "decay for the moving average")
 FLAGS = flags.FLAGS
 
 
+# 输入流水线参数, -1为tf.data.experimental.AUTOTUNE
+def parallel_calls():
+    if FLAGS.parallel_calls < 0:
+        return tf.data.experimental.AUTOTUNE
+    return FLAGS.parallel_calls if FLAGS.parallel_calls > 0 else FLAGS.num_thread
+
+
+def prefetch_batches():
+    return tf.data.experimental.AUTOTUNE if FLAGS.prefetch_batches < 0 else FLAGS.prefetch_batches
+
+
+def shuffle_examples(dataset):
+    return dataset.shuffle(buffer_size=FLAGS.shuffle_buffer, reshuffle_each_iteration=FLAGS.reshuffle == 1)
+
+
+# 取下一个batch, 并记录每步等待输入的时间input_wait_sec(由LoggingTensorHook输出)
+def next_batch(dataset):
+    iterator = dataset.make_one_shot_iterator()
+    start = tf.timestamp()
+    with tf.control_dependencies([start]):
+        batch_features, batch_labels = iterator.get_next()
+    with tf.control_dependencies([batch_labels]):
+        input_wait = tf.identity(tf.timestamp() - start, name="input_wait_sec")
+    tf.summary.scalar("input_wait_sec", input_wait)
+    return batch_features, batch_labels
+
+
+# 多个文件并行交错读取(parallel interleave), 每个epoch重新打散文件顺序, 返回(dataset, 剩余需要repeat的epoch数)
+# cycle_length=0时按原方式reader(filenames)依次读取各文件
+def read_files(filenames, reader, num_epochs=1, perform_shuffle=True):
+    if FLAGS.cycle_length <= 0:
+        return reader(filenames), num_epochs
+    files = tf.data.Dataset.from_tensor_slices(filenames)
+    if perform_shuffle:
+        files = files.shuffle(buffer_size=len(filenames), reshuffle_each_iteration=True)
+    files = files.repeat(num_epochs)            # 每个epoch重新打散文件顺序
+    dataset = files.interleave(reader, cycle_length=FLAGS.cycle_length, block_length=FLAGS.block_length,
+                               num_parallel_calls=FLAGS.cycle_length)
+    return dataset, 1
+
+
+# 解析后数据的缓存位置: None不缓存, ""缓存在内存, 否则为缓存文件前缀
+# 文件名包含输入文件名/大小/修改时间和解析参数的哈希值, 输入文件变化后自动失效, 旧的缓存文件被删除
+def cache_of(filenames, kind):
+    if FLAGS.cache_mode == "memory":
+        return ""
+    if FLAGS.cache_mode != "file":
+        return None
+    stats = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in sorted(filenames)]
+    key = json.dumps([stats, FLAGS.input_format, FLAGS.parse_mode, FLAGS.field_size, FLAGS.crosses])
+    key = hashlib.md5(key.encode("utf-8")).hexdigest()[:16]
+    cache_dir = FLAGS.cache_dir if FLAGS.cache_dir != "" else os.path.join(FLAGS.input_dir, "cache")
+    prefix = os.path.join(cache_dir, "%s_%s%s" % (kind, FLAGS.job_name or "local", FLAGS.task_id or 0))
+    path = "%s_%s" % (prefix, key)
+    for filename in glob.glob(prefix + "_*"):
+        # 过期的缓存, 以及上次运行中断留下的不完整缓存(有lockfile或没有index)
+        if not filename.startswith(path + ".") or os.path.exists(path + ".lockfile") or \
+                not os.path.exists(path + ".index"):
+            os.remove(filename)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    print("Cache ------------- ", path)
+    return path
+
+
+# 缓存解析后的数据, 第2..N个epoch直接读取已解码的feat_idx/feat_val
+# 先读取并解析一个epoch(batched: 按batch解析), 缓存后再打散/repeat/组batch
+def cached_input(filenames, reader, parse_fn, batch_size, num_epochs, perform_shuffle, cache, batched):
+    dataset, _ = read_files(filenames, reader, 1, perform_shuffle)
+    if batched:
+        dataset = dataset.batch(batch_size).map(parse_fn, num_parallel_calls=parallel_calls())
+        dataset = dataset.cache(cache).apply(tf.data.experimental.unbatch())
+    else:
+        dataset = dataset.map(parse_fn, num_parallel_calls=parallel_calls()).cache(cache)
+    if perform_shuffle:
+        dataset = shuffle_examples(dataset)
+    dataset = dataset.repeat(num_epochs).batch(batch_size).prefetch(prefetch_batches())
+    return next_batch(dataset)
+
+
 # 0 1:0.1 2:0.003322 3:0.44 4:0.02 5:0.001594 6:0.016 7:0.02
 # 8:0.04 9:0.008 10:0.166667 11:0.1 12:0 13:0.08
 # 16:1 54:1 77:1 93:1 112:1 124:1 128:1 148:1 160:1 162:1 176:1 209:1 227:1
 # 264:1 273:1 312:1 335:1 387:1 395:1 404:1 407:1 427:1 434:1 443:1 466:1 479:1
-def input_fn(filenames, batch_size=64, num_epochs=1, perform_shuffle=True):
+# 负采样后的数据第一列为label:weight, 例如 0:10 1:0.1 2:0.003322 ...
+# 合并重复样本后label为点击率clicks/impressions, weight为曝光数, 例如 0.25:4 1:0.1 ...
+# 有wide组合特征时每行末尾为组合特征编号, 例如 ... 479:1 391 1423
+def input_fn(filenames, batch_size=64, num_epochs=1, perform_shuffle=True, cache=None):
     print("Parsing ----------- ", filenames)
 
     def dataset_etl(line):
         feat_raw = tf.string_split([line], " ")
-        labels = tf.string_to_number(feat_raw.values[0], out_type=tf.float32)
-        splits = tf.string_split(feat_raw.values[1:], ":")
+        label_wgt = tf.string_split([feat_raw.values[0]], ":").values
+        label_wgt = tf.concat([label_wgt, ["1"]], axis=0)                      # 没有权重列时权重为1
+        labels = tf.string_to_number(label_wgt[0], out_type=tf.float32)
+        weight = tf.string_to_number(label_wgt[1], out_type=tf.float32)
+        splits = tf.string_split(feat_raw.values[1:1 + FLAGS.field_size], ":")
         idx_val = tf.reshape(splits.values, splits.dense_shape)
         feat_idx, feat_val = tf.split(idx_val, num_or_size_splits=2, axis=1)    # 切割张量
         feat_idx = tf.string_to_number(feat_idx, out_type=tf.int32)             # [field_size, 1]
         feat_val = tf.string_to_number(feat_val, out_type=tf.float32)           # [field_size, 1]
-        return {"feat_idx": feat_idx, "feat_val": feat_val}, labels
+        features = {"feat_idx": feat_idx, "feat_val": feat_val, "weight": weight}
+        if cross_num() > 0:
+            wide_idx = feat_raw.values[1 + FLAGS.field_size:]
+            features["wide_idx"] = tf.string_to_number(wide_idx, out_type=tf.int32)     # [cross_num]
+        return features, labels
+
+    def batch_etl(lines):
+        # 一次解析整个batch: 每行token数相同, 切分后直接reshape为[batch, 1+field_size+cross_num]
+        tokens = tf.string_split(lines, " ").values
+        tokens = tf.reshape(tokens, shape=[-1, 1 + FLAGS.field_size + cross_num()])
+        label_wgt = tf.sparse.to_dense(tf.string_split(tokens[:, 0], ":"), default_value="1")
+        label_wgt = tf.concat([label_wgt, tf.fill([tf.shape(label_wgt)[0], 1], "1")], axis=1)  # 没有权重列时为1
+        labels = tf.string_to_number(label_wgt[:, 0], out_type=tf.float32)                  # [batch_size]
+        weight = tf.string_to_number(label_wgt[:, 1], out_type=tf.float32)                  # [batch_size]
+        pairs = tf.reshape(tokens[:, 1:1 + FLAGS.field_size], shape=[-1])
+        idx_val = tf.reshape(tf.string_split(pairs, ":").values, shape=[-1, FLAGS.field_size, 2])
+        feat_idx = tf.string_to_number(idx_val[:, :, 0], out_type=tf.int32)                 # [batch_size, field_size]
+        feat_val = tf.string_to_number(idx_val[:, :, 1], out_type=tf.float32)               # [batch_size, field_size]
+        features = {"feat_idx": feat_idx, "feat_val": feat_val, "weight": weight}
+        if cross_num() > 0:
+            wide_idx = tokens[:, 1 + FLAGS.field_size:]
+            features["wide_idx"] = tf.string_to_number(wide_idx, out_type=tf.int32)        # [batch_size, cross_num]
+        return features, labels
+
+    if cache is not None:
+        batched = FLAGS.parse_mode == "batch"
+        return cached_input(filenames, tf.data.TextLineDataset, batch_etl if batched else dataset_etl,
+                            batch_size, num_epochs, perform_shuffle, cache, batched)
+
+    if FLAGS.parse_mode == "batch":
+        # 先打散/组batch原始文本行, 再按batch向量化解析, 每个batch只调用一次map
+        dataset, num_epochs = read_files(filenames, tf.data.TextLineDataset, num_epochs, perform_shuffle)
+        if perform_shuffle:
+            dataset = shuffle_examples(dataset)
+        dataset = dataset.repeat(num_epochs)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(batch_etl, num_parallel_calls=parallel_calls()).prefetch(prefetch_batches())
+        return next_batch(dataset)          # [batch_size, field_size]
 
     # extract lines from input files[filename or filename list] using the Dataset API,
-    # multi-thread pre-process then prefetch some certain amount of data[25600]
-    dataset = tf.data.TextLineDataset(filenames).map(dataset_etl, num_parallel_calls=4).prefetch(25600)
+    # multi-thread pre-process, batches are prefetched after batching
+    dataset, num_epochs = read_files(filenames, tf.data.TextLineDataset, num_epochs, perform_shuffle)
+    dataset = dataset.map(dataset_etl, num_parallel_calls=parallel_calls())
+
+    # randomize the input data with a window of shuffle_buffer elements (read into memory)
+    if perform_shuffle:
+        dataset = shuffle_examples(dataset)
+
+    # epochs from blending together
+    dataset = dataset.repeat(num_epochs)
+    dataset = dataset.batch(batch_size).prefetch(prefetch_batches())
+    batch_features, batch_labels = next_batch(dataset)      # [batch_size, field_size, 1]
+
+    return batch_features, batch_labels
+
+
+# train.idx.npy: int32 [N, field_size], train.val.npy: float32 [N, field_size], train.lbl.npy: float32 [N]
+# train.wgt.npy: float32 [N], 负采样后的样本权重(可选)
+# train.wide.npy: int32 [N, cross_num], wide组合特征编号(可选)
+def npy_input_fn(filenames, batch_size=64, num_epochs=1, perform_shuffle=True, cache=None, window_size=65536):
+    print("Mapping ----------- ", filenames)
+    # 数据已是二进制矩阵, 不需要解析, cache参数被忽略
+
+    def batch_generator():
+        # 按窗口读取memory-mapped文件, 窗口内打散后切分成batch, 无需解析文本
+        files = list(filenames)
+        if perform_shuffle:
+            random.shuffle(files)       # 每个epoch重新打散文件顺序
+        for filename in files:
+            prefix = filename[:-len(".idx.npy")]
+            feat_idx = np.load(prefix + ".idx.npy", mmap_mode="r")
+            feat_val = np.load(prefix + ".val.npy", mmap_mode="r")
+            labels = np.load(prefix + ".lbl.npy", mmap_mode="r")
+            if os.path.exists(prefix + ".wgt.npy"):
+                weights = np.load(prefix + ".wgt.npy", mmap_mode="r")
+            else:
+                weights = np.ones(labels.shape[0], dtype=np.float32)
+            if cross_num() > 0:
+                wide_idx = np.load(prefix + ".wide.npy", mmap_mode="r")
+            window = max(window_size // batch_size, 1) * batch_size
+            for start in range(0, labels.shape[0], window):
+                end = min(start + window, labels.shape[0])
+                order = np.arange(end - start)
+                if perform_shuffle:
+                    np.random.shuffle(order)
+                win_idx = np.asarray(feat_idx[start:end])[order]
+                win_val = np.asarray(feat_val[start:end])[order]
+                win_lbl = np.asarray(labels[start:end])[order]
+                win_wgt = np.asarray(weights[start:end])[order]
+                if cross_num() > 0:
+                    win_wide = np.asarray(wide_idx[start:end])[order]
+                for k in range(0, end - start, batch_size):
+                    features = {"feat_idx": win_idx[k:k + batch_size],
+                                "feat_val": win_val[k:k + batch_size],
+                                "weight": win_wgt[k:k + batch_size]}
+                    if cross_num() > 0:
+                        features["wide_idx"] = win_wide[k:k + batch_size]
+                    yield features, win_lbl[k:k + batch_size]
+
+    output_types = {"feat_idx": tf.int32, "feat_val": tf.float32, "weight": tf.float32}
+    output_shapes = {"feat_idx": tf.TensorShape([None, FLAGS.field_size]),
+                     "feat_val": tf.TensorShape([None, FLAGS.field_size]),
+                     "weight": tf.TensorShape([None])}
+    if cross_num() > 0:
+        output_types["wide_idx"] = tf.int32
+        output_shapes["wide_idx"] = tf.TensorShape([None, cross_num()])
+    dataset = tf.data.Dataset.from_generator(
+        batch_generator, (output_types, tf.float32), (output_shapes, tf.TensorShape([None])))
+
+    # epochs from blending together, batches are already built by the generator
+    dataset = dataset.repeat(num_epochs).prefetch(prefetch_batches())
+    batch_features, batch_labels = next_batch(dataset)      # [batch_size, field_size]
+
+    return batch_features, batch_labels
+
+
+# tf.train.Example: feat_idx int64 [field_size], feat_val float32 [field_size], label float32
+# weight float32, 负采样后的样本权重(可选); wide_idx int64 [cross_num], wide组合特征编号(可选)
+def tfrecord_input_fn(filenames, batch_size=64, num_epochs=1, perform_shuffle=True, cache=None):
+    print("Parsing ----------- ", filenames)
+    feature_spec = {
+        "feat_idx": tf.FixedLenFeature([FLAGS.field_size], tf.int64),
+        "feat_val": tf.FixedLenFeature([FLAGS.field_size], tf.float32),
+        "label": tf.FixedLenFeature([], tf.float32),
+        "weight": tf.FixedLenFeature([], tf.float32, default_value=1.0)}
+    if cross_num() > 0:
+        feature_spec["wide_idx"] = tf.FixedLenFeature([cross_num()], tf.int64)
 
-    # randomize the input data with a window of 256 elements (read into memory)
+    def dataset_etl(serialized):
+        # 一次解析整个batch的序列化样本, 无字符串切分
+        parsed = tf.parse_example(serialized, feature_spec)
+        labels = parsed.pop("label")
+        return parsed, labels
+
+    def reader(f):
+        return tf.data.TFRecordDataset(f, compression_type=FLAGS.compression)
+
+    if cache is not None:
+        return cached_input(filenames, reader, dataset_etl, batch_size, num_epochs, perform_shuffle, cache, True)
+
+    dataset, num_epochs = read_files(filenames, reader, num_epochs, perform_shuffle)
+
+    # randomize the input data with a window of shuffle_buffer elements (read into memory)
     if perform_shuffle:
-        dataset = dataset.shuffle(buffer_size=256)
+        dataset = shuffle_examples(dataset)
 
     # epochs from blending together
     dataset = dataset.repeat(num_epochs)
     dataset = dataset.batch(batch_size)
-    iterator = dataset.make_one_shot_iterator()
-    batch_features, batch_labels = iterator.get_next()      # [batch_size, field_size, 1]
+    dataset = dataset.map(dataset_etl, num_parallel_calls=parallel_calls()).prefetch(prefetch_batches())
+    batch_features, batch_labels = next_batch(dataset)      # [batch_size, field_size]
 
     return batch_features, batch_labels
 
 
+def cross_num():
+    # wide组合特征个数, 与预处理的--crosses一致
+    return len(FLAGS.crosses.split(',')) if FLAGS.crosses != "" else 0
+
+
+# 在单独的graph中读取一个stage的batch, 统计吞吐量/CPU利用率/每个batch的等待时间, 不包含模型计算
+def bench_stage(name, make_batch):
+    with tf.Graph().as_default():
+        _, batch_labels = make_batch()
+        input_wait = tf.get_default_graph().get_tensor_by_name("input_wait_sec:0")
+        with tf.Session(config=tf.ConfigProto(device_count={"GPU": 0})) as sess:
+            sess.run(batch_labels)          # 第一个batch包含启动开销, 不计入统计
+            examples, waits = 0, []
+            start_time, start_cpu = time.time(), os.times()
+            while FLAGS.bench_steps <= 0 or len(waits) < FLAGS.bench_steps:
+                try:
+                    labels, wait = sess.run([batch_labels, input_wait])
+                except tf.errors.OutOfRangeError:
+                    break
+                examples += labels.shape[0]
+                waits.append(wait)
+            wall_sec = max(time.time() - start_time, 1e-9)
+            end_cpu = os.times()
+    cpu_sec = (end_cpu[0] - start_cpu[0]) + (end_cpu[1] - start_cpu[1])
+    waits = np.array(waits if waits else [0.0]) * 1000
+    stats = {"stage": name, "batches": len(waits), "examples": examples,
+             "examples_per_sec": round(examples / wall_sec, 1),
+             "batches_per_sec": round(len(waits) / wall_sec, 2),
+             "cpu_cores": round(cpu_sec / wall_sec, 2),
+             "cpu_util": round(100.0 * cpu_sec / wall_sec / (os.cpu_count() or 1), 1),
+             "latency_ms": {"mean": round(float(waits.mean()), 3), "p50": round(float(np.percentile(waits, 50)), 3),
+                            "p90": round(float(np.percentile(waits, 90)), 3),
+                            "p99": round(float(np.percentile(waits, 99)), 3)}}
+    print("%-8s %10.1f examples/s %8.2f batches/s, cpu %.2f cores(%.1f%%), latency ms/batch mean %.3f p50 %.3f "
+          "p99 %.3f" % (name, stats["examples_per_sec"], stats["batches_per_sec"], stats["cpu_cores"],
+                        stats["cpu_util"], stats["latency_ms"]["mean"], stats["latency_ms"]["p50"],
+                        stats["latency_ms"]["p99"]))
+    return stats
+
+
+# task_mode=bench_input: 不连接模型, 只运行输入流水线
+# read: 只读取原始记录并组batch; pipeline: reader_fn完整的读取+解析+打散+组batch
+def bench_input(train_files, reader_fn):
+    record_reader = {"text": tf.data.TextLineDataset,
+                     "tfrecord": lambda f: tf.data.TFRecordDataset(f, compression_type=FLAGS.compression)}
+
+    def read_batch():
+        dataset, _ = read_files(train_files, record_reader[FLAGS.input_format], 1, True)
+        dataset = dataset.batch(FLAGS.batch_size).map(lambda records: (records, tf.ones(tf.shape(records))))
+        return next_batch(dataset.prefetch(prefetch_batches()))
+
+    report = []
+    if FLAGS.input_format in record_reader:     # npy数据直接memory-mapped读取, 没有单独的读取阶段
+        report.append(bench_stage("read", read_batch))
+    report.append(bench_stage("pipeline", lambda: reader_fn(train_files, FLAGS.batch_size, 1, True)))
+    print(json.dumps({"input_format": FLAGS.input_format, "parse_mode": FLAGS.parse_mode,
+                      "batch_size": FLAGS.batch_size, "files": len(train_files), "stages": report}))
+
+
 def batch_norm_layer(x, train_phase, scope_bn):
     bn_train = tf.contrib.layers.batch_norm(x, decay=FLAGS.batch_norm_decay, center=True, scale=True, updates_collections=None, is_training=True,  reuse=None, scope=scope_bn)
     bn_infer = tf.contrib.layers.batch_norm(x, decay=FLAGS.batch_norm_decay, center=True, scale=True, updates_collections=None, is_training=False, reuse=True, scope=scope_bn)
@@ -155,11 +456,29 @@ def main(_):
         FLAGS.serve_dir = (date.today() + timedelta(-1)).strftime("%Y%m") + "_exp_" + FLAGS.algorithm
     if FLAGS.input_dir == "":       # windows环境测试
         FLAGS.input_dir = os.path.dirname(os.getcwd()) + "\\data" + "\\data_set_criteo\\"
+    report_size = 0                 # 预处理/增量处理记录的特征数, 包含数值特征分桶和哈希模式
+    for report_name in ["preprocess_report.json", "stream_report.json"]:
+        report_file = os.path.join(FLAGS.input_dir, report_name)
+        if os.path.exists(report_file):
+            with open(report_file) as f:
+                report_size = max(report_size, json.load(f).get("feature_size", 0))
+    if FLAGS["feature_size"].present:   # 命令行显式指定的特征数优先
+        if 0 < report_size != FLAGS.feature_size:
+            print("WARNING: --feature_size %d differs from %d of the preprocessing report"
+                  % (FLAGS.feature_size, report_size))
+    elif report_size > 0:
+        FLAGS.feature_size = report_size
+    elif FLAGS.hash_buckets > 0:    # 哈希模式特征数固定: 13个数值特征 + 每个离散特征(<unk> + 哈希桶)
+        num_categorical = FLAGS.field_size - 13
+        FLAGS.feature_size = 13 + 1 + num_categorical * (FLAGS.hash_buckets + 1)
+    print("feature_size -----", FLAGS.feature_size)
 
-    train_files = glob.glob("%s/train*set" % FLAGS.input_dir)       # 获取指定目录下train文件
-    valid_files = glob.glob("%s/valid*set" % FLAGS.input_dir)       # 获取指定目录下valid文件
-    tests_files = glob.glob("%s/tests*set" % FLAGS.input_dir)       # 获取指定目录下tests文件
+    file_suffix = {"text": "set", "npy": ".idx.npy", "tfrecord": ".tfrecord"}[FLAGS.input_format]
+    train_files = glob.glob("%s/train*%s" % (FLAGS.input_dir, file_suffix))     # 获取指定目录下train文件
+    valid_files = glob.glob("%s/valid*%s" % (FLAGS.input_dir, file_suffix))     # 获取指定目录下valid文件
+    tests_files = glob.glob("%s/tests*%s" % (FLAGS.input_dir, file_suffix))     # 获取指定目录下tests文件
     random.shuffle(train_files)                                     # 打散train文件
+    reader_fn = {"text": input_fn, "npy": npy_input_fn, "tfrecord": tfrecord_input_fn}[FLAGS.input_format]
 
     if FLAGS.clear_mod == "True" and FLAGS.task_mode == "train":    # 删除已存在的模型文件
         try:
@@ -182,6 +501,8 @@ def main(_):
         "deep_layers": FLAGS.deep_layers,
         "cross_layers": FLAGS.cross_layers,
         "dropout": FLAGS.dropout,
+        "cross_num": cross_num(),
+        "cross_buckets": FLAGS.cross_buckets,
         "algorithm": FLAGS.algorithm
     }
     if FLAGS.algorithm == "LR":
@@ -216,25 +537,35 @@ def main(_):
 
     print("==================== 3.Apply CTR model to diff tasks...")
     if FLAGS.task_mode == "train":
+        train_cache = cache_of(train_files, "train")
+        valid_cache = cache_of(valid_files, "valid")
+        # 每log_steps步输出一次等待输入的时间, 用于评估输入流水线是否够快
+        input_wait_hook = tf.train.LoggingTensorHook({"input_wait_sec": "input_wait_sec"},
+                                                     every_n_iter=FLAGS.log_steps)
         train_spec = estimator.TrainSpec(
-            input_fn=lambda: input_fn(train_files, FLAGS.batch_size, FLAGS.num_epochs, True),
-            max_steps=train_step)
+            input_fn=lambda: reader_fn(train_files, FLAGS.batch_size, FLAGS.num_epochs, True, train_cache),
+            max_steps=train_step, hooks=[input_wait_hook])
         eval_spec = estimator.EvalSpec(
-            input_fn=lambda: input_fn(valid_files, FLAGS.batch_size, 1, False), steps=None,
+            input_fn=lambda: reader_fn(valid_files, FLAGS.batch_size, 1, False, valid_cache), steps=None,
             start_delay_secs=50, throttle_secs=15)
         estimator.train_and_evaluate(ctr, train_spec, eval_spec)
     elif FLAGS.task_mode == "eval":
-        ctr.evaluate(input_fn=lambda: input_fn(valid_files, FLAGS.batch_size, 1, False))
+        valid_cache = cache_of(valid_files, "valid")
+        ctr.evaluate(input_fn=lambda: reader_fn(valid_files, FLAGS.batch_size, 1, False, valid_cache))
     elif FLAGS.task_mode == "infer":
         preds = ctr.predict(
-            input_fn=lambda: input_fn(tests_files, FLAGS.batch_size, 1, False), predict_keys="prob")
+            input_fn=lambda: reader_fn(tests_files, FLAGS.batch_size, 1, False), predict_keys="prob")
         with open(FLAGS.input_dir+"/pred_tests.txt", "w") as fo:
             for prob in preds:
                 fo.write("%f\n" % (prob['prob']))
+    elif FLAGS.task_mode == "bench_input":
+        bench_input(train_files, reader_fn)
     elif FLAGS.task_mode == "export":
         feature_spec = {
             "feat_idx": tf.placeholder(dtype=tf.int64, shape=[None, FLAGS.field_size], name="feat_idx"),
             "feat_val": tf.placeholder(dtype=tf.float32, shape=[None, FLAGS.field_size], name="feat_val")}
+        if cross_num() > 0:
+            feature_spec["wide_idx"] = tf.placeholder(dtype=tf.int64, shape=[None, cross_num()], name="wide_idx")
         serving_input_receiver_fn = estimator.export.build_raw_serving_input_receiver_fn(feature_spec)
         ctr.export_savedmodel(FLAGS.serve_dir, serving_input_receiver_fn)
 